@@ -1,17 +1,60 @@
 # apps/api/main.py
-from fastapi import FastAPI, HTTPException, Body
-from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from fastapi import FastAPI, HTTPException, Body, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, List, Generator
+from typing import Optional, Dict, Any, List, Tuple, AsyncGenerator
+from collections import OrderedDict, deque
+from array import array
 import os
+import re
 import json
-import requests
-import psycopg
-from qdrant_client import QdrantClient
+import time
+import random
+import secrets
+import asyncio
+import functools
+import hashlib
+import heapq
+import itertools
+import math
+import sqlite3
+import threading
+import unicodedata
+import zlib
+from urllib.parse import urlsplit
+import httpx
+import numpy as np
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+from qdrant_client import AsyncQdrantClient
 from qdrant_client.http import models as qmodels  # For Filter, etc.
 
-app = FastAPI(title="Dantive Regulatory Bot API", version="0.4.0")
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await open_db_pools()
+    probes.start()
+    residency.start()
+    tracer.start()
+    reranker.warm_up()
+    yield
+    await residency.stop()
+    await probes.stop()
+    await tracer.stop()
+    # Release pooled connections on shutdown
+    await close_db_pools()
+    for client in list(_http_clients.values()):
+        await client.aclose()
+    _http_clients.clear()
+    await qdrant.close()
+    embed_cache.close()
+
+
+app = FastAPI(title="Dantive Regulatory Bot API", version="0.5.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,6 +67,12 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 QDRANT_URL = os.getenv("QDRANT_URL", "http://qdrant:6333")
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434")
 
+# Ollama backend pools (comma lists); embedding and chat traffic may use different nodes
+OLLAMA_URLS = os.getenv("OLLAMA_URLS", OLLAMA_URL)
+OLLAMA_EMBED_URLS = os.getenv("OLLAMA_EMBED_URLS", OLLAMA_URLS)
+OLLAMA_CHAT_URLS = os.getenv("OLLAMA_CHAT_URLS", OLLAMA_URLS)
+OLLAMA_FAIL_COOLDOWN = float(os.getenv("OLLAMA_FAIL_COOLDOWN", "15"))  # seconds a failed node is skipped
+
 # Model defaults
 DEFAULT_MODEL = os.getenv("OLLAMA_DEFAULT_MODEL", os.getenv("GEN_MODEL", "mistral:7b-instruct"))
 COLLECTION = os.getenv("QDRANT_COLLECTION") or "regdocs_v1"
@@ -34,54 +83,779 @@ RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.0"))   # ← relaxed default
 RAG_MIN_DOCS_REQUIRED = int(os.getenv("RAG_MIN_DOCS_REQUIRED", "1"))
 RAG_TOP_K = int(os.getenv("RAG_TOP_K", "8"))
 RAG_TEMPERATURE = float(os.getenv("RAG_TEMPERATURE", os.getenv("GEN_TEMPERATURE", "0.1")))
-RAG_MAX_CHARS = int(os.getenv("RAG_MAX_CHARS", "900"))
+RAG_MAX_CHARS = int(os.getenv("RAG_MAX_CHARS", "900"))  # display only (citation excerpts, raw hits)
+
+# Context assembly: adjacent chunks merged, duplicates dropped, sources packed to the model's context window
+RAG_NUM_CTX = int(os.getenv("RAG_NUM_CTX", os.getenv("LLM_CTX", "0")))  # sent as num_ctx; 0 = model default (/api/show)
+RAG_DEFAULT_NUM_CTX = int(os.getenv("RAG_DEFAULT_NUM_CTX", "2048"))      # when the model does not say
+RAG_ANSWER_TOKENS = int(os.getenv("RAG_ANSWER_TOKENS", os.getenv("GEN_MAX_TOKENS", "512")))  # reserved for the answer
+RAG_CHARS_PER_TOKEN = float(os.getenv("RAG_CHARS_PER_TOKEN", "4"))       # rough estimate for EU legal English
+RAG_MAX_OVERLAP_CHARS = int(os.getenv("RAG_MAX_OVERLAP_CHARS", "400"))   # longest chunk overlap looked for when merging
+
+# Hybrid retrieval: dense + BM25 sparse ("bm25" vector written by seed_qdrant.py) fused with reciprocal-rank fusion
+RAG_HYBRID = os.getenv("RAG_HYBRID", "true").lower() == "true"
+SPARSE_VECTOR_NAME = os.getenv("SPARSE_VECTOR_NAME", "bm25")
+RAG_HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", str(RAG_TOP_K * 2)))  # per index, before fusion
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+
+# Optional reranking between retrieval and prompt building: over-fetch, rerank, keep the best N within a budget
+RERANKER = os.getenv("RERANKER", "none").lower()              # none | cross-encoder | ollama
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))  # retrieved before reranking
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "4"))             # kept for the prompt
+# Past the budget, fall back to retrieval order. The cross-encoder scores 20 x 600-char passages in well under
+# 800 ms on CPU. The ollama reranker prefills ~3k prompt tokens and writes ~200, which is several seconds on a
+# GPU and minutes on CPU; there, lower RERANK_CANDIDATES / RERANK_MAX_CHARS or use the cross-encoder.
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "8000" if RERANKER == "ollama" else "800"))
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")  # cross-encoder (CPU)
+RERANK_OLLAMA_MODEL = os.getenv("RERANK_OLLAMA_MODEL", DEFAULT_MODEL)               # ollama: one batched scoring call
+RERANK_MAX_CHARS = int(os.getenv("RERANK_MAX_CHARS", "600"))   # passage text sent to the reranker
+
+# Exact-reference fast path: "REACH Art. 57(1)" is served from the Postgres spans table (filled by seed_qdrant.py)
+RAG_REF_LOOKUP = os.getenv("RAG_REF_LOOKUP", "supplement").lower()  # supplement | skip (no vector search on a hit) | off
+RAG_REF_MAX_SPANS = int(os.getenv("RAG_REF_MAX_SPANS", "6"))
 
 # Debug/behavior flags
 RAG_DEBUG = os.getenv("RAG_DEBUG", "true").lower() == "true"            # show more info; bypass hard filters
 RAG_FORCE_ANSWER = os.getenv("RAG_FORCE_ANSWER", "true").lower() == "true"  # try to answer even with thin context
 ALLOW_RAW = os.getenv("ALLOW_RAW", "false").lower() == "true"
 
+# Model warm-up: load the generation model while retrieval runs (empty /api/generate with keep_alive)
+RAG_WARMUP = os.getenv("RAG_WARMUP", "true").lower() == "true"
+RAG_WARMUP_TTL = float(os.getenv("RAG_WARMUP_TTL", "60"))  # seconds a model counts as warm after load/use
+
+# Model residency: preload at startup, ping pinned models in the background, report /api/ps on /health
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "5m")                    # sent with every Ollama request
+OLLAMA_KEEP_ALIVE_POLICIES = os.getenv("OLLAMA_KEEP_ALIVE_POLICIES", "")   # per model, e.g. "nomic-embed-text=-1,llama3:8b-instruct=2m"
+OLLAMA_PRELOAD_MODELS = os.getenv("OLLAMA_PRELOAD_MODELS", "")             # comma list; empty = EMBED_MODEL + default model; "none" = off
+OLLAMA_RESIDENCY_INTERVAL = float(os.getenv("OLLAMA_RESIDENCY_INTERVAL", "60"))  # seconds between /api/ps checks and pings; 0 = preload only
+
+# Generation scheduler: bounded concurrent Ollama generations per model behind a priority queue
+GEN_CONCURRENCY = int(os.getenv("GEN_CONCURRENCY", os.getenv("OLLAMA_NUM_PARALLEL", "1")))  # per model and chat node
+GEN_QUEUE_MAX = int(os.getenv("GEN_QUEUE_MAX", "16"))               # waiting requests per model; more => 429
+GEN_QUEUE_MAX_WAIT = float(os.getenv("GEN_QUEUE_MAX_WAIT", "30"))   # seconds waiting for a slot; longer => 503
+GEN_SHORT_TOKENS = int(os.getenv("GEN_SHORT_TOKENS", "1500"))       # prompt + answer tokens up to this run as "short"
+
+# Query-embedding cache (in-memory LRU + optional on-disk tier that survives restarts)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))     # entries kept in memory; 0 disables the cache
+EMBED_CACHE_TTL = float(os.getenv("EMBED_CACHE_TTL", "86400"))     # seconds; 0 = never expire
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "")               # e.g. /workspace/cache/embed_cache.sqlite3
+
+# Answer cache for full RAG responses (exact key on retrieved chunks + near-duplicate questions)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))     # 0 disables
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))   # seconds; 0 = never expire
+ANSWER_CACHE_SIM_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIM_THRESHOLD", "0.97"))  # cosine; >= 1.0 disables near-dup
+ANSWER_CACHE_STAMP_TTL = float(os.getenv("ANSWER_CACHE_STAMP_TTL", "30"))  # seconds between collection version checks
+
+# Single-flight: identical concurrent questions (model, prompt, mode, temperature) share one pipeline
+RAG_COALESCE = os.getenv("RAG_COALESCE", "true").lower() == "true"
+
+# Postgres connection pools (async pool opened in lifespan; the sync pool, for code running in worker threads,
+# is created on first use)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_SYNC_POOL_MIN = int(os.getenv("DB_SYNC_POOL_MIN", "0"))
+DB_SYNC_POOL_MAX = int(os.getenv("DB_SYNC_POOL_MAX", "2"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "2"))                  # seconds to wait for a pooled connection
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))              # close idle connections above min after this
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))  # server-side cap per statement; 0 = none
+
+# Dependency probes (background task; /health and /ready read the cached results)
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "10"))   # seconds between probe rounds
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "1.5"))    # per dependency
+HEALTH_STALE_AFTER = float(os.getenv("HEALTH_STALE_AFTER", str(3 * HEALTH_PROBE_INTERVAL)))  # /ready fails past this age
+
 # Timeouts (seconds)
 OLLAMA_CONNECT_TIMEOUT = int(os.getenv("OLLAMA_CONNECT_TIMEOUT", "10"))
 OLLAMA_READ_TIMEOUT = int(os.getenv("OLLAMA_READ_TIMEOUT", "600"))
 
-# Clients
-qdrant = QdrantClient(url=QDRANT_URL, prefer_grpc=False)
+# HTTP connection pool (keep-alive; one pool per upstream host)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))                # idle keep-alive connections kept per host
+HTTP_POOL_MAX_PER_HOST = int(os.getenv("HTTP_POOL_MAX_PER_HOST", "100"))  # concurrent connections per host (0 = unlimited)
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))     # seconds; doubles per attempt
+HTTP_RETRY_STATUSES = {502, 503, 504}
+
+# Tracing: W3C traceparent in and out; spans for the request, its stages and Ollama calls, exported as JSON
+TRACE_FILE = os.getenv("TRACE_FILE", "")                       # JSON lines, one span per line
+TRACE_URL = os.getenv("TRACE_URL", "")                         # collector taking POST {"spans": [...]} (OTLP stand-in)
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "1.0"))         # share of requests traced when the caller did not decide
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "2"))  # seconds between exports
+TRACE_BUFFER_MAX = int(os.getenv("TRACE_BUFFER_MAX", "10000"))  # spans held between exports; more are dropped
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_POOL_MAX_PER_HOST or None,
+        max_keepalive_connections=HTTP_POOL_SIZE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
 
 
-# ——— Health
-@app.get("/health")
-def health():
-    ok: Dict[str, Any] = {"api": "ok"}
+# Clients (async; pooled connections are closed in lifespan)
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+qdrant = AsyncQdrantClient(url=QDRANT_URL, prefer_grpc=False, limits=_http_limits())
 
-    # DB
-    try:
-        if DATABASE_URL:
-            with psycopg.connect(DATABASE_URL) as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT 1;")
-            ok["db"] = "ok"
+
+def http_for(base_url: str) -> httpx.AsyncClient:
+    """Shared keep-alive client for one upstream host, created on first use."""
+    client = _http_clients.get(base_url)
+    if client is None:
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+            limits=_http_limits(),
+        )
+        _http_clients[base_url] = client
+    return client
+
+
+# Postgres pools (None when DATABASE_URL is unset)
+db_pool: Optional[AsyncConnectionPool] = None
+db_pool_sync: Optional[ConnectionPool] = None
+_db_pool_sync_lock = threading.Lock()
+
+
+def _db_pool_kwargs() -> dict:
+    options = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}" if DB_STATEMENT_TIMEOUT_MS > 0 else ""
+    return {
+        "conninfo": DATABASE_URL,
+        "kwargs": {"options": options} if options else None,
+        "timeout": DB_POOL_TIMEOUT,
+        "max_idle": DB_POOL_MAX_IDLE,
+        "open": False,
+    }
+
+
+async def open_db_pools() -> None:
+    """Create the async pool; connections are made in the background so startup does not wait on the DB."""
+    global db_pool
+    if not DATABASE_URL:
+        return
+    db_pool = AsyncConnectionPool(min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, name="api-async", **_db_pool_kwargs())
+    await db_pool.open()
+
+
+def sync_db_pool() -> Optional[ConnectionPool]:
+    """
+    The pool for blocking code in worker threads, created on first call so an API without sync
+    callers holds no connections for it. None when there is no database or the pools are closed.
+    """
+    global db_pool_sync
+    with _db_pool_sync_lock:
+        if db_pool_sync is None and db_pool is not None:
+            db_pool_sync = ConnectionPool(min_size=DB_SYNC_POOL_MIN, max_size=DB_SYNC_POOL_MAX, name="api-sync",
+                                          **_db_pool_kwargs())
+            db_pool_sync.open()
+        return db_pool_sync
+
+
+async def close_db_pools() -> None:
+    global db_pool, db_pool_sync
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+    with _db_pool_sync_lock:
+        pool, db_pool_sync = db_pool_sync, None
+    if pool is not None:
+        await asyncio.to_thread(pool.close)
+
+
+def db_pool_stats() -> Optional[dict]:
+    if db_pool is None:
+        return None
+    return {
+        "statement_timeout_ms": DB_STATEMENT_TIMEOUT_MS,
+        "acquire_timeout_s": DB_POOL_TIMEOUT,
+        "async": db_pool.get_stats(),
+        "sync": db_pool_sync.get_stats() if db_pool_sync is not None else None,  # None until first use
+    }
+
+
+# Errors that happen before the upstream saw the request (or on a stale keep-alive socket); safe to retry
+_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.PoolTimeout)
+
+
+async def http_send(method: str, base_url: str, path: str, *, stream: bool = False, retries: Optional[int] = None,
+                    **kwargs) -> httpx.Response:
+    """
+    Send a request over the pooled client for base_url, retrying connection errors and
+    502/503/504 with exponential backoff (retries defaults to HTTP_MAX_RETRIES; 0 = one attempt).
+    With stream=True the caller must aclose() the response.
+    """
+    client = http_for(base_url)
+    traceparent = tracer.traceparent()
+    if traceparent:
+        kwargs["headers"] = {**(kwargs.get("headers") or {}), "traceparent": traceparent}
+    request = client.build_request(method, path, **kwargs)
+    retries = HTTP_MAX_RETRIES if retries is None else retries
+    delay = HTTP_RETRY_BACKOFF
+    for attempt in range(retries + 1):
+        last = attempt >= retries
+        try:
+            r = await client.send(request, stream=stream)
+        except _RETRYABLE_ERRORS:
+            if last:
+                raise
         else:
-            ok["db"] = "skipped"
-    except Exception as e:
-        ok["db"] = f"err:{e}"
+            if last or r.status_code not in HTTP_RETRY_STATUSES:
+                return r
+            await r.aclose()
+        await asyncio.sleep(delay)
+        delay *= 2
+    raise RuntimeError("unreachable")
+
+
+# ——— Metrics (Prometheus, served on /metrics)
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Latency of one pipeline stage", ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+REQUESTS_IN_FLIGHT = Gauge("rag_requests_in_flight", "Requests being served", ["endpoint"])
+OLLAMA_TOKENS = Counter("ollama_tokens_total", "Tokens processed by Ollama", ["model", "kind"])
+OLLAMA_TOKENS_PER_SECOND = Histogram(
+    "ollama_eval_tokens_per_second", "Generation speed (eval_count / eval_duration)", ["model"],
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200),
+)
+RETRIEVED_HITS = Histogram(
+    "rag_retrieved_hits", "Hits per query from each index, and after fusion", ["source"],
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64),
+)
+HIT_SCORE = Histogram(
+    "rag_hit_score", "Cosine scores of dense hits, and of the best fused result", ["kind"],
+    buckets=tuple(i / 10 for i in range(1, 11)),
+)
 
-    # Qdrant
-    try:
-        r = requests.get(f"{QDRANT_URL}/readyz", timeout=1.5)
-        ok["qdrant"] = "ok" if r.ok else f"err:{r.status_code}"
-    except Exception as e:
-        ok["qdrant"] = f"err:{e}"
+# Per-request stage timings (ms); tasks started by the request share the dict
+_stage_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("stage_timings", default=None)
+
+
+def _observe_stage(name: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(name).observe(seconds)
+    timings = _stage_timings.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + seconds * 1000, 1)
+
+
+def record_stage(name: str, seconds: float) -> None:
+    """A stage that just ended after `seconds` (when a with-block cannot wrap it)."""
+    _observe_stage(name, seconds)
+    tracer.emit(name, seconds)
 
-    # Ollama
+
+@contextmanager
+def stage(name: str):
+    t0 = time.perf_counter()
+    cancelled = False
     try:
-        r = requests.get(f"{OLLAMA_URL}/api/tags", timeout=1.5)
-        ok["ollama"] = "ok" if r.ok else f"err:{r.status_code}"
-    except Exception as e:
-        ok["ollama"] = f"err:{e}"
+        with tracer.span(name):
+            yield
+    except asyncio.CancelledError:
+        cancelled = True  # abandoned work (e.g. a speculative search) is not a latency sample
+        raise
+    finally:
+        if not cancelled:
+            _observe_stage(name, time.perf_counter() - t0)
+
+
+def staged(name: str):
+    """Decorator: time an async function as a pipeline stage."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def inner(*args, **kwargs):
+            with stage(name):
+                return await fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def start_stage_timings() -> Dict[str, float]:
+    timings: Dict[str, float] = {}
+    _stage_timings.set(timings)
+    return timings
+
+
+def stage_timings() -> Optional[Dict[str, float]]:
+    timings = _stage_timings.get()
+    return dict(timings) if timings is not None else None
+
+
+def observe_generation(model: str, final: dict) -> None:
+    """Token counts and speed from the final Ollama response object."""
+    if final.get("prompt_eval_count"):
+        OLLAMA_TOKENS.labels(model, "prompt").inc(final["prompt_eval_count"])
+    if final.get("eval_count"):
+        OLLAMA_TOKENS.labels(model, "eval").inc(final["eval_count"])
+        if final.get("eval_duration"):
+            OLLAMA_TOKENS_PER_SECOND.labels(model).observe(final["eval_count"] / (final["eval_duration"] / 1e9))
+
+
+class _StatsCollector:
+    """Exports the counters the caches, scheduler and backend pool already keep, read at scrape time."""
+
+    def collect(self):
+        lookups = CounterMetricFamily("rag_cache_lookups", "Cache lookups by result", labels=["cache", "result"])
+        for result, key in (("hit", "hits"), ("disk_hit", "disk_hits"), ("miss", "misses")):
+            lookups.add_metric(["embed", result], embed_cache.stats()[key])
+        for result, key in (("hit", "hits"), ("similar_hit", "similar_hits"), ("miss", "misses")):
+            lookups.add_metric(["answer", result], answer_cache.stats()[key])
+        yield lookups
+
+        coalesced = CounterMetricFamily("rag_coalesced_requests", "Requests that joined an identical in-flight one")
+        coalesced.add_metric([], single_flight.joined)
+        yield coalesced
+
+        active = GaugeMetricFamily("rag_generation_active", "Generation slots in use", labels=["model"])
+        queued = GaugeMetricFamily("rag_generation_queued", "Requests waiting for a generation slot", labels=["model"])
+        rejected = CounterMetricFamily("rag_generation_rejected", "Requests refused by admission control", labels=["model", "reason"])
+        for model, q in gen_scheduler.stats()["models"].items():
+            active.add_metric([model], q["active"])
+            queued.add_metric([model], q["queued"])
+            for reason, n in q["rejected"].items():
+                rejected.add_metric([model, reason], n)
+        yield active
+        yield queued
+        yield rejected
+
+        up = GaugeMetricFamily("ollama_node_up", "Node not benched after a failure", labels=["node"])
+        outstanding = GaugeMetricFamily("ollama_node_outstanding", "Requests in flight per node", labels=["node"])
+        for n in ollama_backends.snapshot():
+            up.add_metric([n["url"]], 1 if n["up"] else 0)
+            outstanding.add_metric([n["url"]], n["outstanding"])
+        yield up
+        yield outstanding
+
+
+# ——— Tracing
+_current_span: ContextVar[Optional[dict]] = ContextVar("current_span", default=None)
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Tracer:
+    """
+    Minimal W3C trace-context tracer. Spans are dicts with OTLP-like fields (trace_id, span_id,
+    parent_span_id, name, start/end_unix_nano, attributes, status); the current one lives in a context
+    variable, so tasks started by a request nest under it. A background task exports finished spans in
+    batches: JSON lines to TRACE_FILE and/or one POST per batch to TRACE_URL.
+    """
+
+    def __init__(self, path: str, url: str, sample: float, interval: float, buffer_max: int):
+        self.path = path
+        self.url = url
+        self.sample = sample
+        self.interval = interval
+        self.buffer_max = buffer_max
+        self.enabled = bool(path or url)
+        self.exported = 0
+        self.dropped = 0
+        self._buffer: List[dict] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def _new(self, name: str, trace_id: str, parent_id: Optional[str], attrs: dict) -> dict:
+        return {
+            "trace_id": trace_id,
+            "span_id": secrets.token_hex(8),
+            "parent_span_id": parent_id,
+            "name": name,
+            "start_unix_nano": time.time_ns(),
+            "end_unix_nano": None,
+            "attributes": dict(attrs),
+            "status": "ok",
+        }
+
+    def end(self, span: Optional[dict], error: Optional[BaseException] = None) -> None:
+        if span is None or span["end_unix_nano"] is not None:
+            return
+        span["end_unix_nano"] = time.time_ns()
+        if error is not None:
+            span["status"] = "error"
+            span["attributes"]["error"] = str(getattr(error, "detail", "") or error) or type(error).__name__
+        if len(self._buffer) < self.buffer_max:
+            self._buffer.append(span)
+        else:
+            self.dropped += 1
+
+    def start_request(self, name: str, traceparent: Optional[str], **attrs) -> Optional[dict]:
+        """Server span for an incoming request; continues the caller's trace when it sent a traceparent."""
+        if not self.enabled:
+            return None
+        m = _TRACEPARENT_RE.match((traceparent or "").strip().lower())
+        if m:
+            trace_id, parent_id, sampled = m.group(1), m.group(2), int(m.group(3), 16) & 1 == 1
+        else:
+            trace_id, parent_id, sampled = secrets.token_hex(16), None, random.random() < self.sample
+        if not sampled:
+            return None
+        span = self._new(name, trace_id, parent_id, {"span.kind": "server", **attrs})
+        _current_span.set(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Child of the current span (no-op outside a traced request)."""
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        span = self._new(name, parent["trace_id"], parent["span_id"], attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            self.end(span, e)
+            raise
+        else:
+            self.end(span)
+        finally:
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                pass  # an abandoned stream finalized from another task; that context is gone anyway
+
+    def emit(self, name: str, seconds: float) -> None:
+        """A finished child span of the current span that ended now."""
+        parent = _current_span.get()
+        if parent is not None:
+            span = self._new(name, parent["trace_id"], parent["span_id"], {})
+            span["start_unix_nano"] -= int(seconds * 1e9)
+            self.end(span)
+
+    def annotate(self, **attrs) -> None:
+        span = _current_span.get()
+        if span is not None:
+            span["attributes"].update(attrs)
+
+    def traceparent(self) -> Optional[str]:
+        span = _current_span.get()
+        return f"00-{span['trace_id']}-{span['span_id']}-01" if span else None
+
+    def _append(self, batch: List[dict]) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in batch:
+                f.write(json.dumps(span, ensure_ascii=False) + "\n")
+
+    async def flush(self) -> None:
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        try:
+            if self.path:
+                await asyncio.to_thread(self._append, batch)
+            if self.url:
+                u = urlsplit(self.url)
+                r = await http_send("POST", f"{u.scheme}://{u.netloc}", u.path or "/", json={"service": "dantive-api", "spans": batch})
+                r.raise_for_status()
+        except (OSError, httpx.HTTPError) as e:
+            self.dropped += len(batch)
+            print(f"[WARN] trace export failed, {len(batch)} spans dropped: {e}", flush=True)
+            return
+        self.exported += len(batch)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "file": self.path or None,
+            "url": self.url or None,
+            "sample": self.sample,
+            "buffered": len(self._buffer),
+            "exported": self.exported,
+            "dropped": self.dropped,
+        }
+
+
+tracer = Tracer(TRACE_FILE, TRACE_URL, TRACE_SAMPLE, TRACE_FLUSH_INTERVAL, TRACE_BUFFER_MAX)
+
+
+def trace_id_headers(span: Optional[dict]) -> Dict[str, str]:
+    return {"X-Trace-Id": span["trace_id"]} if span else {}
+
+
+# ——— Ollama backends
+class _OllamaNode:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.down_until = 0.0
+        self.last_error: Optional[str] = None
+        self.models: Optional[set] = None  # from /api/tags; None = not known yet
+        self.tags_at: Optional[float] = None
+
+    def up(self, now: float) -> bool:
+        return now >= self.down_until
+
+
+class OllamaBackends:
+    """
+    Ollama nodes grouped into pools ("embed", "chat"); a node listed in both shares one set of counters.
+    A request goes to the healthy node with the fewest outstanding requests among those that have the
+    model (per /api/tags). Connection errors and any 5xx (Ollama answers 500 when a model fails to load or
+    runs out of memory) fail over to the next node and bench the failed one for a cooldown; a 404 (model
+    not on that node) also moves on. While another live node remains, a node gets no same-node retries.
+    """
+
+    def __init__(self, pools: Dict[str, List[str]], cooldown: float):
+        self.cooldown = cooldown
+        self.nodes: Dict[str, _OllamaNode] = {}
+        self.pools: Dict[str, List[_OllamaNode]] = {}
+        for pool, urls in pools.items():
+            self.pools[pool] = [self.nodes.setdefault(u, _OllamaNode(u)) for u in dict.fromkeys(urls)]
+        self._turn = itertools.count()
+
+    def hosting(self, pool: str, model: str) -> List[_OllamaNode]:
+        """Nodes of the pool that have the model; all of them when no tag list says so (tags may be stale)."""
+        key = _model_key(model)
+        nodes = [n for n in self.pools[pool] if n.models is None or key in n.models]
+        return nodes or self.pools[pool]
+
+    def capacity(self, pool: str, model: str) -> int:
+        now = time.time()
+        return max(1, sum(1 for n in self.hosting(pool, model) if n.up(now)))
+
+    def candidates(self, pool: str, model: str) -> List[_OllamaNode]:
+        """Routing order: healthy nodes by outstanding requests (ties rotate), then benched ones by recovery time."""
+        now = time.time()
+        nodes = self.hosting(pool, model)
+        turn = next(self._turn)
+        up = sorted(
+            (n for n in nodes if n.up(now)),
+            key=lambda n: (n.outstanding, (nodes.index(n) - turn) % len(nodes)),
+        )
+        down = sorted((n for n in nodes if not n.up(now)), key=lambda n: n.down_until)
+        return up + down
+
+    def _fail(self, node: _OllamaNode, error: str) -> None:
+        node.errors += 1
+        node.last_error = error
+        node.down_until = time.time() + self.cooldown
+        print(f"[WARN] ollama node {node.url} failed ({error}); skipped for {self.cooldown:g}s", flush=True)
+
+    @asynccontextmanager
+    async def request(self, pool: str, model: str, method: str, path: str, *, stream: bool = False, **kwargs):
+        """
+        Send to the best node, failing over before any response is handed out. The request counts as
+        outstanding on its node until the block exits; with stream=True the response is closed on exit.
+        """
+        with tracer.span(f"ollama {path}", model=model, pool=pool, stream=stream):
+            async with self._request(pool, model, method, path, stream=stream, **kwargs) as r:
+                yield r
+
+    @asynccontextmanager
+    async def _request(self, pool: str, model: str, method: str, path: str, *, stream: bool = False, **kwargs):
+        nodes = self.candidates(pool, model)
+        for i, node in enumerate(nodes):
+            last = i == len(nodes) - 1
+            # Failing over beats backing off on the same node; retry in place only with nowhere else to go
+            now = time.time()
+            retries = 0 if any(n.up(now) for n in nodes[i + 1:]) else None
+            node.outstanding += 1
+            node.requests += 1
+            r: Optional[httpx.Response] = None
+            try:
+                try:
+                    r = await http_send(method, node.url, path, stream=stream, retries=retries, **kwargs)
+                except httpx.TransportError as e:
+                    self._fail(node, str(e) or type(e).__name__)
+                    if last:
+                        raise
+                    continue
+                if not last and r.status_code >= 500:
+                    self._fail(node, f"HTTP {r.status_code}")
+                    continue
+                if not last and r.status_code == 404:
+                    if node.models is not None:
+                        node.models.discard(_model_key(model))
+                    continue
+                node.down_until = 0.0
+                tracer.annotate(node=node.url, status_code=r.status_code, attempts=i + 1)
+                try:
+                    yield r
+                except httpx.TransportError as e:  # broke mid-stream: too late to fail over, but bench the node
+                    self._fail(node, str(e) or type(e).__name__)
+                    raise
+                return
+            finally:
+                node.outstanding -= 1
+                if r is not None:
+                    await r.aclose()
+
+    async def send(self, pool: str, model: str, method: str, path: str, **kwargs) -> httpx.Response:
+        async with self.request(pool, model, method, path, **kwargs) as r:
+            return r
+
+    async def _tags(self, node: _OllamaNode, timeout: float) -> None:
+        try:
+            r = await http_send("GET", node.url, "/api/tags", timeout=timeout)
+            r.raise_for_status()
+            node.models = {m.get("name") for m in r.json().get("models") or []}
+            node.tags_at = time.time()
+            node.down_until = 0.0
+        except (httpx.HTTPError, ValueError) as e:
+            self._fail(node, str(e) or type(e).__name__)
+
+    async def refresh(self, timeout: float) -> str:
+        """Re-read /api/tags on every node; "ok" while each pool has at least one live node."""
+        await asyncio.gather(*(self._tags(n, timeout) for n in self.nodes.values()))
+        now = time.time()
+        dead = [pool for pool, nodes in self.pools.items() if not any(n.up(now) for n in nodes)]
+        return f"err:no live {'/'.join(dead)} node" if dead else "ok"
+
+    def snapshot(self) -> List[dict]:
+        now = time.time()
+        return [
+            {
+                "url": n.url,
+                "pools": [pool for pool, nodes in self.pools.items() if n in nodes],
+                "up": n.up(now),
+                "outstanding": n.outstanding,
+                "requests": n.requests,
+                "errors": n.errors,
+                "last_error": n.last_error,
+                "models": sorted(n.models) if n.models is not None else None,
+            }
+            for n in self.nodes.values()
+        ]
+
+
+def _urls(spec: str) -> List[str]:
+    return [u.strip().rstrip("/") for u in spec.split(",") if u.strip()]
+
+
+ollama_backends = OllamaBackends(
+    {"embed": _urls(OLLAMA_EMBED_URLS), "chat": _urls(OLLAMA_CHAT_URLS)}, OLLAMA_FAIL_COOLDOWN
+)
+
+
+# ——— Health
+class DependencyProbes:
+    """
+    Probes DB, Qdrant and Ollama on an interval in a background task and keeps the last result per
+    dependency (status, latency, timestamp), so /health and /ready never wait on upstreams.
+    """
+
+    def __init__(self, interval: float, timeout: float, stale_after: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.results: Dict[str, dict] = {}
+        self.rounds = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _db(self) -> str:
+        if db_pool is None:
+            return "skipped"
+        async with db_pool.connection(timeout=self.timeout) as conn:
+            await conn.execute("SELECT 1;")
+        return "ok"
+
+    async def _ollama(self) -> str:
+        return await ollama_backends.refresh(self.timeout)
+
+    async def _http(self, base_url: str, path: str) -> str:
+        r = await http_send("GET", base_url, path, timeout=self.timeout)
+        return "ok" if r.is_success else f"err:{r.status_code}"
+
+    async def _timed(self, name: str, probe) -> None:
+        t0 = time.perf_counter()
+        try:
+            status = await asyncio.wait_for(probe, timeout=self.timeout + 0.5)
+        except asyncio.TimeoutError:
+            status = f"err:timeout after {self.timeout}s"
+        except Exception as e:
+            status = f"err:{e}"
+        self.results[name] = {
+            "status": status,
+            "latency_ms": round((time.perf_counter() - t0) * 1000, 1),
+            "checked_at": time.time(),
+        }
+
+    async def run_once(self) -> None:
+        await asyncio.gather(
+            self._timed("db", self._db()),
+            self._timed("qdrant", self._http(QDRANT_URL, "/readyz")),
+            self._timed("ollama", self._ollama()),
+        )
+        self.rounds += 1
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:  # never let the probe task die
+                print(f"[WARN] dependency probe round failed: {e}", flush=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def status(self, name: str) -> str:
+        r = self.results.get(name)
+        return r["status"] if r else "pending"
+
+    def snapshot(self) -> Dict[str, dict]:
+        now = time.time()
+        return {
+            name: {**r, "age_s": round(now - r["checked_at"], 1)}
+            for name, r in self.results.items()
+        }
+
+    def ready(self) -> Tuple[bool, Dict[str, dict]]:
+        """Ready = every dependency passed (or was skipped) in a probe that is not stale."""
+        checks = self.snapshot()
+        ok = len(checks) == 3 and all(
+            c["status"] in ("ok", "skipped") and c["age_s"] <= self.stale_after for c in checks.values()
+        )
+        return ok, checks
+
+
+probes = DependencyProbes(HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT, HEALTH_STALE_AFTER)
+
+
+@app.get("/health")
+async def health():
+    """Liveness plus the last cached dependency probe results; never calls upstreams itself."""
+    ok: Dict[str, Any] = {"api": "ok"}
+    ok["db"] = probes.status("db")
+    ok["qdrant"] = probes.status("qdrant")
+    ok["ollama"] = probes.status("ollama")
+    ok["probes"] = probes.snapshot()
+    ok["probe_interval_s"] = probes.interval
+    ok["ollama_backends"] = ollama_backends.snapshot()
 
     ok["collection"] = COLLECTION
     ok["embed_model"] = EMBED_MODEL
+    ok["models"] = residency.snapshot()
     ok["rag"] = {
         "min_score": RAG_MIN_SCORE,
         "min_docs": RAG_MIN_DOCS_REQUIRED,
@@ -89,13 +863,42 @@ def health():
         "temperature": RAG_TEMPERATURE,
         "debug": RAG_DEBUG,
         "force_answer": RAG_FORCE_ANSWER,
+        "hybrid": RAG_HYBRID,
+        "reference_lookup": RAG_REF_LOOKUP if db_pool is not None else "off",
     }
     ok["allow_raw"] = ALLOW_RAW
+    ok["embed_cache"] = embed_cache.stats()
+    ok["answer_cache"] = answer_cache.stats()
+    ok["coalescing"] = single_flight.stats()
+    ok["generation"] = gen_scheduler.stats()
+    ok["tracing"] = tracer.stats()
+    ok["rerank"] = reranker.stats()
+    ok["db_pool"] = db_pool_stats()
+    ok["http_pool"] = {
+        "hosts": sorted(_http_clients),
+        "keepalive_per_host": HTTP_POOL_SIZE,
+        "max_per_host": HTTP_POOL_MAX_PER_HOST or None,
+        "max_retries": HTTP_MAX_RETRIES,
+    }
     return ok
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus exposition: stage latencies, Ollama tokens, retrieval hits/scores, caches, queues, nodes."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness from the last probe round: 200 when DB/Qdrant/Ollama were all reachable, else 503."""
+    is_ready, checks = probes.ready()
+    body = {"ready": is_ready, "checks": checks, "stale_after_s": probes.stale_after}
+    return JSONResponse(body, status_code=200 if is_ready else 503)
+
+
 @app.get("/")
-def root():
+async def root():
     return {"message": "Dantive Regulatory Bot API — RAG with debug mode and citations."}
 
 
@@ -127,6 +930,7 @@ def _build_payload(
         "model": model,
         "prompt": prompt,
         "stream": stream,  # IMPORTANT: explicit to avoid NDJSON surprises
+        "keep_alive": residency.keep_alive(model),
         "options": {
             "temperature": RAG_TEMPERATURE if temperature is None else temperature,
             "top_p": 0.9 if top_p is None else top_p,
@@ -138,62 +942,391 @@ def _build_payload(
     return payload
 
 
-def _ollama_nonstream(payload: dict) -> str:
+async def _ollama_nonstream(payload: dict, priority: Optional[int] = None) -> str:
     try:
-        r = requests.post(
-            f"{OLLAMA_URL}/api/generate",
-            json=payload,
-            timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT),
-        )
+        async with gen_scheduler.slot(payload["model"], gen_priority(payload) if priority is None else priority):
+            r = await ollama_backends.send("chat", payload["model"], "POST", "/api/generate", json=payload)
         r.raise_for_status()
         # must be a single JSON object
         data = r.json()
+        observe_generation(payload["model"], data)
         return (data.get("response") or "").strip()
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"Ollama request failed: {e}")
     except json.JSONDecodeError as e:
         # This happens if Ollama streamed (NDJSON) unexpectedly
         raise HTTPException(status_code=502, detail=f"Ollama returned non-JSON (stream?) for non-stream request: {e}")
 
 
+async def _ollama_stream_events(payload: dict) -> AsyncGenerator[dict, None]:
+    """
+    Yield the parsed NDJSON objects of a streaming /api/generate call, up to and including done=true.
+    Non-JSON lines are wrapped as {"response": line}. Transport errors propagate (httpx.HTTPError).
+    The caller holds the generation slot (gen_scheduler.slot) for the whole stream.
+    """
+    async with ollama_backends.request("chat", payload["model"], "POST", "/api/generate", json=payload, stream=True) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if not line:
+                continue
+            try:
+                j = json.loads(line)
+            except json.JSONDecodeError:
+                # Pass through raw line if it isn't JSON (rare)
+                yield {"response": line}
+                continue
+            yield j
+            if j.get("done"):
+                observe_generation(payload["model"], j)
+                break
+
+
+async def _ollama_stream(payload: dict) -> AsyncGenerator[str, None]:
+    """Yield response tokens from a streaming /api/generate call (NDJSON)."""
+    try:
+        async with gen_scheduler.slot(payload["model"], gen_priority(payload)):
+            async for j in _ollama_stream_events(payload):
+                if j.get("response"):
+                    yield j["response"]
+    except httpx.HTTPError as e:
+        yield f"\n[stream error: {e}]"
+    except HTTPException as e:
+        yield f"\n[stream error: {e.detail}]"
+
+
+def _model_key(name: str) -> str:
+    """Ollama reports "nomic-embed-text" as "nomic-embed-text:latest"."""
+    return name if ":" in name else f"{name}:latest"
+
+
+def _keep_alive_value(raw: str) -> Any:
+    """Ollama takes durations ("30m") or seconds as a number (-1 = keep loaded, 0 = unload now)."""
+    raw = raw.strip()
+    return int(raw) if re.fullmatch(r"-?\d+", raw) else raw
+
+
+def _keep_alive_policies(spec: str) -> Dict[str, Any]:
+    policies: Dict[str, Any] = {}
+    for item in spec.split(","):
+        name, sep, value = item.strip().rpartition("=")
+        if not sep or not name or not value.strip():
+            if item.strip():
+                print(f"[WARN] ignoring keep_alive policy {item.strip()!r} (expected model=duration)", flush=True)
+            continue
+        policies[_model_key(name.strip())] = _keep_alive_value(value)
+    return policies
+
+
+class ModelResidency:
+    """
+    Keeps the configured Ollama models loaded. Pinned models are preloaded at startup and pinged in a
+    background task (a load request with the model's keep_alive, which also resets Ollama's unload timer);
+    every request carries its model's keep_alive. /api/ps is polled so /health shows what is resident.
+    """
+
+    def __init__(self, pinned: List[str], policies: Dict[str, Any], default_keep_alive: str, interval: float):
+        self.pinned = list(dict.fromkeys(_model_key(m) for m in pinned))
+        self.policies = policies
+        self.default_keep_alive = _keep_alive_value(default_keep_alive)
+        self.interval = interval
+        self.models: Dict[str, dict] = {}  # per model: last use/load, load time, load count, last error
+        self.resident: Optional[List[dict]] = None  # last /api/ps answer
+        self.checked_at: Optional[float] = None
+        self._loads: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def keep_alive(self, model: str) -> Any:
+        return self.policies.get(_model_key(model), self.default_keep_alive)
+
+    def _state(self, model: str) -> dict:
+        return self.models.setdefault(_model_key(model), {"loads": 0, "used_at": 0.0})
+
+    def touch(self, model: str) -> None:
+        """Record that the model just served a request (so it is loaded for another keep_alive)."""
+        self._state(model)["used_at"] = time.time()
+
+    @staticmethod
+    def pool(model: str) -> str:
+        return "embed" if _model_key(model) == _model_key(EMBED_MODEL) else "chat"
+
+    async def _load_on(self, model: str, url: str) -> None:
+        st = self._state(model)
+        keep_alive = self.keep_alive(model)
+        t0 = time.perf_counter()
+        try:
+            # No prompt: Ollama only loads the model and keeps it for keep_alive
+            if self.pool(model) == "embed":
+                r = await http_send("POST", url, "/api/embeddings", json={"model": model, "prompt": "", "keep_alive": keep_alive})
+            else:
+                r = await http_send("POST", url, "/api/generate", json={"model": model, "keep_alive": keep_alive})
+            r.raise_for_status()
+        except httpx.HTTPError as e:
+            st["error"] = f"{url}: {str(e) or type(e).__name__}"
+            print(f"[WARN] loading {model} failed on {st['error']}", flush=True)
+            return
+        st.update(loads=st["loads"] + 1, load_ms=round((time.perf_counter() - t0) * 1000, 1), error=None)
+        st["loaded_at"] = st["used_at"] = time.time()
+
+    def _nodes(self, model: str) -> List[str]:
+        # Every live node that serves the model keeps it loaded: routing may pick any of them
+        now = time.time()
+        return [n.url for n in ollama_backends.hosting(self.pool(model), model) if n.up(now)]
+
+    async def _load(self, model: str) -> None:
+        await asyncio.gather(*(self._load_on(model, url) for url in self._nodes(model)))
+
+    def load(self, model: str) -> asyncio.Task:
+        """Start (or join) a background load of the model on its nodes."""
+        key = _model_key(model)
+        task = self._loads.get(key)
+        if task is None or task.done():
+            task = self._loads[key] = asyncio.create_task(self._load(model))
+        return task
+
+    def warm(self, model: str) -> str:
+        """Start loading the model in the background unless it was loaded/used recently; returns what happened."""
+        if not RAG_WARMUP:
+            return "off"
+        if time.time() - self._state(model)["used_at"] < RAG_WARMUP_TTL:
+            return "warm"
+        task = self._loads.get(_model_key(model))
+        if task is not None and not task.done():
+            return "loading"
+        self.load(model)
+        return "started"
+
+    async def _ps(self, url: str) -> List[dict]:
+        try:
+            r = await http_send("GET", url, "/api/ps", timeout=5)
+            r.raise_for_status()
+            models = r.json().get("models") or []
+        except (httpx.HTTPError, ValueError):
+            return []  # node health is the probes' job
+        return [
+            {
+                "name": m.get("name"),
+                "node": url,
+                "size_vram_mb": round((m.get("size_vram") or 0) / 2**20),
+                "expires_at": m.get("expires_at"),
+            }
+            for m in models
+        ]
+
+    async def refresh(self) -> None:
+        per_node = await asyncio.gather(*(self._ps(url) for url in ollama_backends.nodes))
+        self.resident = [m for models in per_node for m in models]
+        self.checked_at = time.time()
+
+    async def ping(self) -> None:
+        """Reload pinned models gone from any of their nodes; refresh the keep_alive of idle ones (unless -1)."""
+        loaded = {(m["node"], m["name"]) for m in self.resident or []}
+        now = time.time()
+        due = [
+            m for m in self.pinned
+            if any((url, m) not in loaded for url in self._nodes(m))
+            or (now - self._state(m)["used_at"] >= self.interval and self.keep_alive(m) != -1)
+        ]
+        if due:
+            await asyncio.gather(*(self.load(m) for m in due))
+            await self.refresh()
+
+    async def _loop(self) -> None:
+        await asyncio.gather(*(self.load(m) for m in self.pinned))
+        while self.interval > 0:  # 0 = preload only, no /api/ps checks or pings
+            try:
+                await self.refresh()
+                await self.ping()
+            except Exception as e:  # never let the residency task die
+                print(f"[WARN] model residency check failed: {e}", flush=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        tasks = [t for t in [self._task, *self._loads.values()] if t is not None and not t.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        return {
+            "pinned": self.pinned,
+            "keep_alive": {"default": self.default_keep_alive, **self.policies},
+            "interval_s": self.interval or None,
+            "resident": self.resident,
+            "checked_age_s": round(now - self.checked_at, 1) if self.checked_at else None,
+            "models": {
+                name: {
+                    "loads": st["loads"],
+                    "load_ms": st.get("load_ms"),
+                    "loaded_age_s": round(now - st["loaded_at"], 1) if st.get("loaded_at") else None,
+                    "idle_s": round(now - st["used_at"], 1) if st["used_at"] else None,
+                    "error": st.get("error"),
+                }
+                for name, st in self.models.items()
+            },
+        }
+
+
+def _preload_models() -> List[str]:
+    if OLLAMA_PRELOAD_MODELS.strip().lower() == "none":
+        return []
+    if OLLAMA_PRELOAD_MODELS.strip():
+        return [m.strip() for m in OLLAMA_PRELOAD_MODELS.split(",") if m.strip()]
+    return [EMBED_MODEL, DEFAULT_MODEL]
+
+
+residency = ModelResidency(
+    _preload_models(), _keep_alive_policies(OLLAMA_KEEP_ALIVE_POLICIES), OLLAMA_KEEP_ALIVE, OLLAMA_RESIDENCY_INTERVAL
+)
+
+
+# Priority classes for generation slots (lower runs first)
+PRIORITY_INTERACTIVE = 0  # latency-budgeted helper calls (reranker scoring)
+PRIORITY_SHORT = 1
+PRIORITY_LONG = 2
+_PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_SHORT: "short", PRIORITY_LONG: "long"}
+
+
+def gen_priority(payload: dict) -> int:
+    """Short prompts with short answers go ahead of long ones: prompt tokens + num_predict (or the answer reserve)."""
+    answer = (payload.get("options") or {}).get("num_predict") or RAG_ANSWER_TOKENS
+    return PRIORITY_SHORT if _tokens(payload.get("prompt") or "") + answer <= GEN_SHORT_TOKENS else PRIORITY_LONG
+
+
+class _ModelSlots:
+    def __init__(self):
+        self.active = 0
+        self.waiting: List[Tuple[int, int, asyncio.Future]] = []  # heap of (priority, arrival, future)
+        self.waits_ms: "deque[float]" = deque(maxlen=256)
+        self.service_s = 0.0  # moving average of slot hold time
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "wait_timeout": 0}
+        self.by_priority = {name: 0 for name in _PRIORITY_NAMES.values()}
+
+
+class GenerationScheduler:
+    """
+    Admission control for Ollama generation. Each model gets `concurrency` slots; further requests wait
+    in a priority queue (then arrival order). A full queue is rejected at once with 429, a request that
+    waits longer than max_wait gets 503; both carry Retry-After estimated from recent service times.
+    """
+
+    def __init__(self, concurrency: int, max_queue: int, max_wait: float):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._models: Dict[str, _ModelSlots] = {}
+        self._arrivals = itertools.count()
+
+    def _slots(self, model: str) -> _ModelSlots:
+        return self._models.setdefault(model, _ModelSlots())
+
+    def limit(self, model: str) -> int:
+        """Slots scale with the live chat nodes that serve the model."""
+        return self.concurrency * ollama_backends.capacity("chat", model)
+
+    def retry_after(self, q: _ModelSlots, model: str) -> int:
+        per_request = q.service_s or 10.0
+        return max(1, math.ceil(per_request * (len(q.waiting) + 1) / self.limit(model)))
+
+    def _reject(self, q: _ModelSlots, model: str, reason: str, status: int, detail: str) -> HTTPException:
+        q.rejected[reason] += 1
+        return HTTPException(status_code=status, detail=f"{detail} ({model})", headers={"Retry-After": str(self.retry_after(q, model))})
+
+    async def _acquire(self, model: str, priority: int) -> float:
+        q = self._slots(model)
+        t0 = time.perf_counter()
+        if q.active < self.limit(model) and not q.waiting:
+            q.active += 1
+        else:
+            if len(q.waiting) >= self.max_queue:
+                raise self._reject(q, model, "queue_full", 429, "Generation queue is full")
+            entry = (priority, next(self._arrivals), asyncio.get_running_loop().create_future())
+            heapq.heappush(q.waiting, entry)
+            try:
+                # The slot is handed over by _release; shield so a timeout cannot lose a slot granted meanwhile
+                await asyncio.wait_for(asyncio.shield(entry[2]), timeout=self.max_wait)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if entry[2].done():
+                    self._release(q, model)  # granted as we gave up: pass it on
+                else:
+                    entry[2].cancel()
+                    q.waiting.remove(entry)
+                    heapq.heapify(q.waiting)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise self._reject(q, model, "wait_timeout", 503, f"No generation slot within {self.max_wait:g}s")
+                raise
+        q.admitted += 1
+        q.by_priority[_PRIORITY_NAMES.get(priority, "long")] += 1
+        q.waits_ms.append((time.perf_counter() - t0) * 1000)
+        record_stage("queue", time.perf_counter() - t0)
+        return time.perf_counter()
+
+    def _release(self, q: _ModelSlots, model: str) -> None:
+        q.active -= 1
+        # Hand slots to waiters in priority order; the limit may have changed with node health
+        while q.waiting and q.active < self.limit(model):
+            _, _, fut = heapq.heappop(q.waiting)
+            if not fut.done():
+                fut.set_result(None)
+                q.active += 1
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int = PRIORITY_SHORT):
+        started = await self._acquire(model, priority)
+        q = self._slots(model)
+        try:
+            yield
+        finally:
+            held = time.perf_counter() - started
+            q.service_s = held if not q.service_s else 0.8 * q.service_s + 0.2 * held
+            self._release(q, model)
+
+    def stats(self) -> dict:
+        out = {}
+        for model, q in self._models.items():
+            waits = sorted(q.waits_ms)
+            out[model] = {
+                "limit": self.limit(model),
+                "active": q.active,
+                "queued": len(q.waiting),
+                "admitted": q.admitted,
+                "rejected": dict(q.rejected),
+                "by_priority": dict(q.by_priority),
+                "wait_ms_p50": round(waits[len(waits) // 2], 1) if waits else None,
+                "wait_ms_p95": round(waits[int(len(waits) * 0.95)], 1) if waits else None,
+                "wait_ms_max": round(waits[-1], 1) if waits else None,
+                "service_s_avg": round(q.service_s, 2) if q.service_s else None,
+            }
+        return {
+            "concurrency_per_model": self.concurrency,
+            "max_queue": self.max_queue,
+            "max_wait_s": self.max_wait,
+            "models": out,
+        }
+
+
+gen_scheduler = GenerationScheduler(GEN_CONCURRENCY, GEN_QUEUE_MAX, GEN_QUEUE_MAX_WAIT)
+
+
 if ALLOW_RAW:
     @app.post("/ask_raw", response_model=AskResponseRaw)
-    def ask_raw(req: AskBase):
+    async def ask_raw(req: AskBase):
         model = req.model or DEFAULT_MODEL
         payload = _build_payload(req.prompt, model, req.temperature, req.top_p, req.max_tokens, stream=False)
-        out = _ollama_nonstream(payload)
+        out = await _ollama_nonstream(payload)
         return AskResponseRaw(model=model, output=out)
 
     @app.post("/ask_stream")
-    def ask_stream(req: AskBase):
+    async def ask_stream(req: AskBase):
         model = req.model or DEFAULT_MODEL
         payload = _build_payload(req.prompt, model, req.temperature, req.top_p, req.max_tokens, stream=True)
-
-        def gen() -> Generator[str, None, None]:
-            try:
-                with requests.post(
-                    f"{OLLAMA_URL}/api/generate",
-                    json=payload,
-                    stream=True,
-                    timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT),
-                ) as r:
-                    r.raise_for_status()
-                    for line in r.iter_lines(decode_unicode=True):
-                        if not line:
-                            continue
-                        try:
-                            j = json.loads(line)
-                            if "response" in j and j["response"]:
-                                yield j["response"]
-                            if j.get("done"):
-                                break
-                        except json.JSONDecodeError:
-                            # Pass through raw line if it isn't JSON (rare)
-                            yield line
-            except requests.exceptions.RequestException as e:
-                yield f"\n[stream error: {e}]"
-
-        return StreamingResponse(gen(), media_type="text/plain")
+        return StreamingResponse(_ollama_stream(payload), media_type="text/plain")
 
 
 # ——— STRICT/RELAXED RAG
@@ -202,8 +1335,10 @@ class Citation(BaseModel):
     source_name: Optional[str]
     source_path: Optional[str]
     chunk_index: Optional[int]
+    chunk_indexes: Optional[List[int]] = None  # all chunks merged into this source
     score: float
     excerpt: Optional[str] = None
+    ref_label: Optional[str] = None
 
 
 class AskResponseRAG(BaseModel):
@@ -214,46 +1349,364 @@ class AskResponseRAG(BaseModel):
     policy: dict
 
 
-def embed_query(q: str) -> List[float]:
+def normalize_query(q: str) -> str:
+    """Canonical form used both as the embedding input and as the cache key."""
+    return " ".join(unicodedata.normalize("NFC", q).split())
+
+
+class EmbeddingCache:
+    """
+    LRU + TTL cache for query embeddings keyed on (model, normalized text).
+    If a path is given, entries are also written to a small SQLite file (float32 blobs)
+    so that repeated questions stay cheap across restarts.
+    """
+
+    def __init__(self, max_size: int, ttl: float, path: str = ""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._mem: "OrderedDict[str, Tuple[float, List[float]]]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        if path and max_size > 0:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embed_cache ("
+                    " key TEXT PRIMARY KEY, model TEXT NOT NULL, created REAL NOT NULL, vec BLOB NOT NULL)"
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"[WARN] embedding cache disk tier disabled ({path}): {e}", flush=True)
+                self._db = None
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha1(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _disk_get(self, key: str) -> Optional[Tuple[float, List[float]]]:
+        with self._db_lock:
+            row = self._db.execute("SELECT created, vec FROM embed_cache WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        return row[0], array("f", row[1]).tolist()
+
+    def _disk_put(self, key: str, model: str, created: float, vec: List[float]) -> None:
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO embed_cache (key, model, created, vec) VALUES (?, ?, ?, ?)",
+                (key, model, created, array("f", vec).tobytes()),
+            )
+            self._db.commit()
+
+    def _remember(self, key: str, created: float, vec: List[float]) -> None:
+        self._mem[key] = (created, vec)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_size:
+            self._mem.popitem(last=False)
+
+    async def get(self, model: str, text: str) -> Optional[List[float]]:
+        if self.max_size <= 0:
+            return None
+        key = self.key(model, text)
+        entry = self._mem.get(key)
+        if entry is not None:
+            if not self._expired(entry[0]):
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._mem[key]
+        if self._db is not None:
+            try:
+                entry = await asyncio.to_thread(self._disk_get, key)
+            except sqlite3.Error:
+                entry = None
+            if entry is not None and not self._expired(entry[0]):
+                self._remember(key, *entry)
+                self.disk_hits += 1
+                return entry[1]
+        self.misses += 1
+        return None
+
+    async def put(self, model: str, text: str, vec: List[float]) -> None:
+        if self.max_size <= 0:
+            return
+        key = self.key(model, text)
+        created = time.time()
+        self._remember(key, created, vec)
+        if self._db is not None:
+            try:
+                await asyncio.to_thread(self._disk_put, key, model, created, vec)
+            except sqlite3.Error as e:
+                print(f"[WARN] embedding cache write failed: {e}", flush=True)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "enabled": self.max_size > 0,
+            "size": len(self._mem),
+            "max_size": self.max_size,
+            "ttl_s": self.ttl,
+            "persistent": self._db is not None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+        }
+
+    def close(self) -> None:
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+
+embed_cache = EmbeddingCache(EMBED_CACHE_SIZE, EMBED_CACHE_TTL, EMBED_CACHE_PATH)
+
+
+@staged("embed")
+async def embed_query(q: str) -> List[float]:
+    text = normalize_query(q)
+    cached = await embed_cache.get(EMBED_MODEL, text)
+    if cached is not None:
+        return cached
     try:
-        r = requests.post(
-            f"{OLLAMA_URL}/api/embeddings",
-            json={"model": EMBED_MODEL, "prompt": q},
-            timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT),
+        r = await ollama_backends.send(
+            "embed", EMBED_MODEL, "POST", "/api/embeddings",
+            json={"model": EMBED_MODEL, "prompt": text, "keep_alive": residency.keep_alive(EMBED_MODEL)},
         )
         r.raise_for_status()
         j = r.json()
-        return j["embedding"]
-    except requests.exceptions.RequestException as e:
+        vec = j["embedding"]
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"Embedding request failed: {e}")
     except (KeyError, ValueError, json.JSONDecodeError) as e:
         raise HTTPException(status_code=502, detail=f"Embedding response malformed: {e}")
+    residency.touch(EMBED_MODEL)
+    await embed_cache.put(EMBED_MODEL, text, vec)
+    return vec
+
+
+# Keep the tokenizer in sync with seed_qdrant.py: queries and chunks must map terms to the same indices.
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or shall that the this to was were which with".split()
+)
+_LEX_TOKEN_RE = re.compile(r"\d{2,7}-\d{2,3}-\d|\d+/\d+|\d+[a-z]?(?:\([0-9a-z]{1,4}\))+|[^\W_]+")
+_LEX_PART_RE = re.compile(r"[^\W_]+")
+
+
+def lexical_terms(text: str) -> List[str]:
+    """Lowercased terms plus the parts of compound legal references, so "57(f)" also matches "Article 57"."""
+    terms: List[str] = []
+    for m in _LEX_TOKEN_RE.finditer(unicodedata.normalize("NFKC", text).lower()):
+        tok = m.group(0)
+        if tok in _STOPWORDS or (len(tok) == 1 and not tok.isdigit()):
+            continue
+        terms.append(tok)
+        if "(" in tok or "/" in tok:  # CAS / EC numbers stay whole
+            terms.extend(p for p in _LEX_PART_RE.findall(tok) if len(p) > 1 or p.isdigit())
+    return terms
+
+
+def sparse_query(text: str) -> Optional[qmodels.SparseVector]:
+    # Each distinct query term counts once; Qdrant weights it by IDF against the stored BM25 tf values
+    indices = sorted({zlib.crc32(t.encode("utf-8")) for t in lexical_terms(text)})
+    if not indices:
+        return None
+    return qmodels.SparseVector(indices=indices, values=[1.0] * len(indices))
+
+
+_sparse_warned = False
 
 
-def retrieve(vec: List[float]) -> List[dict]:
+@staged("sparse_search")
+async def _sparse_search(question: str, limit: int) -> list:
+    """Lexical hits (with their dense vectors, so they get a comparable cosine score); [] if unavailable."""
+    global _sparse_warned
+    sv = sparse_query(question) if RAG_HYBRID and question else None
+    if sv is None:
+        return []
     try:
-        hits = qdrant.search(collection_name=COLLECTION, query_vector=vec, limit=RAG_TOP_K)
+        return await qdrant.search(
+            collection_name=COLLECTION,
+            query_vector=qmodels.NamedSparseVector(name=SPARSE_VECTOR_NAME, vector=sv),
+            limit=limit,
+            with_vectors=True,
+        )
     except Exception as e:
-        raise HTTPException(status_code=502, detail=f"Vector search failed: {e}")
+        # e.g. a collection seeded before sparse vectors existed: degrade to dense-only
+        if not _sparse_warned:
+            print(f"[WARN] sparse search unavailable, using dense only: {e}", flush=True)
+            _sparse_warned = True
+        return []
+
+
+def _candidate_limit(top_k: int) -> int:
+    return max(top_k, RAG_HYBRID_CANDIDATES) if RAG_HYBRID else top_k
+
 
+@staged("dense_search")
+async def _dense_search(vec: List[float], limit: int) -> list:
+    return await qdrant.search(collection_name=COLLECTION, query_vector=vec, limit=limit)
+
+
+async def retrieve(vec: List[float], question: str = "", top_k: int = RAG_TOP_K, sparse_hits=None) -> List[dict]:
+    """Dense + sparse search fused with RRF. sparse_hits may be an already running _sparse_search()."""
+    limit = _candidate_limit(top_k)
+    dense, sparse = await asyncio.gather(
+        _dense_search(vec, limit),
+        sparse_hits if sparse_hits is not None else _sparse_search(question, limit),
+        return_exceptions=True,
+    )
+    if isinstance(dense, BaseException):
+        raise HTTPException(status_code=502, detail=f"Vector search failed: {dense}")
+    if isinstance(sparse, BaseException):
+        sparse = []
+
+    # Reciprocal-rank fusion: each index contributes 1 / (k + rank) for every hit it returned
+    fused: Dict[Any, dict] = {}
+    for name, hits in (("dense", dense), ("sparse", sparse)):
+        for rank, h in enumerate(hits, start=1):
+            f = fused.setdefault(h.id, {"hit": h, "rrf": 0.0, "dense_rank": None, "sparse_rank": None})
+            f["rrf"] += 1.0 / (RAG_RRF_K + rank)
+            f[f"{name}_rank"] = rank
+            if name == "sparse":
+                f["sparse_score"] = float(h.score)
+    ranked = sorted(fused.values(), key=lambda f: f["rrf"], reverse=True)[:top_k]
+    RETRIEVED_HITS.labels("dense").observe(len(dense))
+    RETRIEVED_HITS.labels("sparse").observe(len(sparse))
+    RETRIEVED_HITS.labels("fused").observe(len(ranked))
+    for h in dense:
+        HIT_SCORE.labels("dense").observe(float(h.score))
+
+    vec_norm = sum(x * x for x in vec) ** 0.5
     results = []
-    for h in hits:
+    for f in ranked:
+        h = f["hit"]
+        if f["dense_rank"] is not None:
+            score = float(h.score)
+        else:
+            # Sparse-only hit: cosine from its stored dense vector keeps RAG_MIN_SCORE meaningful
+            dv = h.vector.get("") if isinstance(h.vector, dict) else h.vector
+            score = _cosine(dv, vec, vec_norm) if dv else 0.0
         p = h.payload or {}
-        txt = p.get("text")
-        if txt:
-            txt = txt[:RAG_MAX_CHARS]
         results.append(
             {
-                "score": float(h.score),
+                "id": h.id,
+                "score": score,
                 "source_name": p.get("source_name"),
                 "source_path": p.get("source_path"),
+                "file_sha1": p.get("file_sha1"),
                 "chunk_index": p.get("chunk_index"),
-                "text": txt,
+                "text": p.get("text"),
+                "ref_label": p.get("ref_label"),
+                "rrf": round(f["rrf"], 6),
+                "dense_rank": f["dense_rank"],
+                "sparse_rank": f["sparse_rank"],
+                "sparse_score": f.get("sparse_score"),
             }
         )
+    if results:
+        HIT_SCORE.labels("top").observe(max(r["score"] for r in results))
     return results
 
 
+# ——— Exact reference lookup (Postgres spans)
+REF_DOC_CELEX = {
+    "reach": "32006R1907", "1907/2006": "32006R1907",
+    "bpr": "32012R0528", "528/2012": "32012R0528",
+    "clp": "32008R1272", "1272/2008": "32008R1272",
+}
+_REF_DOC = r"(?P<doc>REACH|BPR|CLP|(?:Regulation\s+\((?:EC|EU)\)\s+No\.?\s*)?(?:1907/2006|528/2012|1272/2008))"
+_REF_LOC = (
+    r"(?:Art(?:icle)?s?\.?\s*(?P<art>\d{1,3}[a-z]?)|Annex\s+(?P<anx>[IVXL]+)\b)"
+    r"(?P<sub>(?:\s?\([0-9a-z]{1,4}\))*)"
+)
+_REF_PATTERNS = (
+    re.compile(_REF_DOC + r"\s*,?\s*" + _REF_LOC, re.IGNORECASE),                         # REACH Art. 57(1)
+    re.compile(_REF_LOC + r"\s*,?\s*(?:(?:of|to|in|under)\s+)?(?:the\s+)?" + _REF_DOC, re.IGNORECASE),  # Article 19 of BPR
+)
+
+
+def parse_references(question: str) -> List[dict]:
+    """Explicit citations in a question; a (1) right after the article number is taken as the paragraph."""
+    refs: List[dict] = []
+    for pat in _REF_PATTERNS:
+        for m in pat.finditer(question):
+            doc = re.sub(r".*?(\d+/\d+)$", r"\1", m.group("doc").lower())
+            celex = REF_DOC_CELEX.get(doc)
+            subs = re.findall(r"\(([0-9a-z]{1,4})\)", m.group("sub") or "", re.IGNORECASE)
+            ref = {
+                "celex": celex,
+                "article": m.group("art").lower() if m.group("art") else None,
+                "annex": m.group("anx").upper() if m.group("anx") else None,
+                "paragraph": subs[0] if subs and subs[0].isdigit() else None,
+            }
+            if celex and ref not in refs:
+                refs.append(ref)
+    return refs
+
+
+_SPAN_SQL = """
+SELECT s.span_id, s.ref_label, s.text, s.chunk_index, d.source_name
+FROM spans s JOIN documents d ON d.doc_id = s.doc_id
+WHERE d.celex = %(celex)s AND s.{col} = %(value)s AND (%(paragraph)s::text IS NULL OR s.paragraph = %(paragraph)s)
+ORDER BY s.span_id
+LIMIT %(limit)s
+"""
+
+
+@staged("references")
+async def lookup_references(question: str) -> List[dict]:
+    """Spans for explicit citations in the question, shaped like retrieve() results; [] when unavailable."""
+    if RAG_REF_LOOKUP == "off" or db_pool is None:
+        return []
+    refs = parse_references(question)
+    if not refs:
+        return []
+    out: List[dict] = []
+    try:
+        async with db_pool.connection() as conn:
+            for ref in refs:
+                col, value = ("article", ref["article"]) if ref["article"] else ("annex", ref["annex"])
+                params = {"celex": ref["celex"], "value": value, "paragraph": ref["paragraph"], "limit": RAG_REF_MAX_SPANS}
+                cur = await conn.execute(_SPAN_SQL.format(col=col), params)
+                rows = await cur.fetchall()
+                if not rows and ref["paragraph"]:
+                    # No numbered paragraph by that name (e.g. a point): fall back to the whole article/annex
+                    cur = await conn.execute(_SPAN_SQL.format(col=col), {**params, "paragraph": None})
+                    rows = await cur.fetchall()
+                for span_id, label, text, chunk_index, source_name in rows:
+                    out.append(
+                        {
+                            "id": f"span:{span_id}",
+                            "score": 1.0,
+                            "source_name": source_name,
+                            "source_path": None,
+                            "chunk_index": chunk_index,
+                            "text": text,
+                            "ref_label": label,
+                            "via": "reference",
+                        }
+                    )
+    except Exception as e:
+        print(f"[WARN] reference lookup failed: {e}", flush=True)
+        return []
+    return out[:RAG_REF_MAX_SPANS]
+
+
+def merge_reference_hits(spans: List[dict], results: List[dict]) -> List[dict]:
+    """Exact spans first; vector hits on the chunks those spans came from are dropped as duplicates."""
+    seen = {(r["source_name"], r["chunk_index"]) for r in spans}
+    return spans + [r for r in results if (r["source_name"], r["chunk_index"]) not in seen]
+
+
 def eligible(results: List[dict]) -> List[dict]:
     """In debug mode, do not filter by score to ensure we always pass something through."""
     if RAG_DEBUG:
@@ -261,11 +1714,137 @@ def eligible(results: List[dict]) -> List[dict]:
     return [r for r in results if r["score"] >= RAG_MIN_SCORE]
 
 
-def build_sources_block(els: List[dict]) -> str:
-    if not els:
+# ——— Reranking
+class Reranker:
+    """
+    Scores (question, passage) pairs with a local cross-encoder (sentence-transformers, run in a thread)
+    or with one batched Ollama call that returns a JSON list of relevance scores.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind if kind in ("cross-encoder", "ollama") else "none"
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.total_ms = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.kind != "none"
+
+    def _cross_encoder(self):
+        with self._model_lock:
+            if self._model is None:
+                try:
+                    from sentence_transformers import CrossEncoder
+                except ImportError as e:
+                    raise RuntimeError("RERANKER=cross-encoder needs: pip install sentence-transformers") from e
+                self._model = CrossEncoder(RERANK_MODEL, device="cpu")
+        return self._model
+
+    def _predict(self, question: str, texts: List[str]) -> List[float]:
+        # Runs in a worker thread; the first call may still be waiting on the model load
+        return [float(x) for x in self._cross_encoder().predict([(question, t) for t in texts])]
+
+    async def _load(self) -> None:
+        try:
+            await asyncio.to_thread(self._cross_encoder)
+        except Exception as e:
+            print(f"[WARN] reranker model not loaded: {e}", flush=True)
+
+    def warm_up(self) -> None:
+        """Load the cross-encoder in the background so the first request does not pay for it."""
+        if self.kind == "cross-encoder":
+            asyncio.create_task(self._load())
+
+    async def _ollama_scores(self, question: str, texts: List[str]) -> List[float]:
+        passages = "\n".join(f"[{i}] {t}" for i, t in enumerate(texts, start=1))
+        payload = {
+            "model": RERANK_OLLAMA_MODEL,
+            "prompt": (
+                f"Query: {question}\n\nPassages:\n{passages}\n\n"
+                "Rate how well each passage answers the query, from 0 (irrelevant) to 10 (answers it fully). "
+                f'Reply with JSON only: {{"scores": [...]}} with exactly {len(texts)} numbers, in passage order.'
+            ),
+            "stream": False,
+            "keep_alive": residency.keep_alive(RERANK_OLLAMA_MODEL),
+            "format": "json",
+            "options": {"temperature": 0, "num_predict": 8 * len(texts) + 32},
+        }
+        scores = json.loads(await _ollama_nonstream(payload, PRIORITY_INTERACTIVE)).get("scores")
+        if not isinstance(scores, list) or len(scores) != len(texts):
+            raise ValueError(f"expected {len(texts)} scores, got {scores!r}")
+        return [float(x) for x in scores]
+
+    async def scores(self, question: str, texts: List[str]) -> List[float]:
+        texts = [t[:RERANK_MAX_CHARS] for t in texts]
+        if self.kind == "cross-encoder":
+            return await asyncio.to_thread(self._predict, question, texts)
+        return await self._ollama_scores(question, texts)
+
+    def stats(self) -> dict:
+        return {
+            "reranker": self.kind,
+            "model": RERANK_MODEL if self.kind == "cross-encoder" else RERANK_OLLAMA_MODEL if self.enabled else None,
+            "candidates": RERANK_CANDIDATES,
+            "top_n": RERANK_TOP_N,
+            "budget_ms": RERANK_BUDGET_MS,
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "avg_ms": round(self.total_ms / self.calls, 1) if self.calls else None,
+        }
+
+
+reranker = Reranker(RERANKER)
+
+
+async def select_context(question: str, results: List[dict]) -> Tuple[List[dict], Optional[dict]]:
+    """
+    Chunks that go into the prompt, plus a rerank report for the retrieval block. Exact reference spans
+    stay first; the rest are reranked and cut to RERANK_TOP_N. On timeout/error the retrieval order is kept.
+    """
+    cands = eligible(results)
+    if not reranker.enabled:
+        return cands[:RAG_TOP_K], None
+    pinned = [r for r in cands if r.get("via") == "reference"]
+    rest = [r for r in cands if r.get("via") != "reference" and r.get("text")]
+    keep = max(0, RERANK_TOP_N - len(pinned))
+    info = {"reranker": reranker.kind, "candidates": len(rest), "kept": 0, "status": "ok", "ms": 0.0}
+    if not rest or not keep:
+        info["status"] = "skipped"
+        return pinned[:RERANK_TOP_N] or cands[:RERANK_TOP_N], info
+    t0 = time.perf_counter()
+    try:
+        with stage("rerank"):
+            scores = await asyncio.wait_for(
+                reranker.scores(question, [r["text"] for r in rest]), timeout=RERANK_BUDGET_MS / 1000
+            )
+        order = sorted(range(len(rest)), key=lambda i: scores[i], reverse=True)
+        ranked = [{**rest[i], "rerank_score": round(scores[i], 4), "retrieval_rank": i + 1} for i in order]
+    except asyncio.TimeoutError:
+        reranker.timeouts += 1
+        info["status"] = "timeout"
+        ranked = rest
+    except Exception as e:
+        reranker.errors += 1
+        info["status"] = f"error: {e}"
+        ranked = rest
+    ms = (time.perf_counter() - t0) * 1000
+    reranker.calls += 1
+    reranker.total_ms += ms
+    els = pinned + ranked[:keep]
+    info.update(kept=len(els), ms=round(ms, 1))
+    return els, info
+
+
+def build_sources_block(sources: List[dict]) -> str:
+    if not sources:
         return "(none)"
     lines = []
-    for i, r in enumerate(els, start=1):
+    for i, r in enumerate(sources, start=1):
         if r.get("text"):
             lines.append(f"[{i}] {r['text']}")
         else:
@@ -317,26 +1896,567 @@ def system_prompt(user_q: str, sources_block: str) -> str:
     return relaxed_system_prompt(user_q, sources_block) if RAG_FORCE_ANSWER else strict_system_prompt(user_q, sources_block)
 
 
-def call_ollama_nonstream(prompt: str, model: str) -> str:
+def prompt_mode() -> str:
+    return "relaxed" if RAG_FORCE_ANSWER else "strict"
+
+
+# ——— Context assembly
+_num_ctx_cache: Dict[str, int] = {}
+_CONTINUATION_RE = re.compile(r"^\[[^\]\n]{1,80}\]\s+")  # "[REACH Art.57] " prefix of a continued chunk
+
+
+def _gen_options() -> dict:
+    """Generation options shared by the RAG endpoints (num_ctx pinned so the token budget holds)."""
+    opts: Dict[str, Any] = {"temperature": RAG_TEMPERATURE}
+    if RAG_NUM_CTX:
+        opts["num_ctx"] = RAG_NUM_CTX
+    return opts
+
+
+async def model_num_ctx(model: str) -> int:
+    """Context window the model will run with: RAG_NUM_CTX, else its Modelfile num_ctx, else the default."""
+    if RAG_NUM_CTX:
+        return RAG_NUM_CTX
+    if model not in _num_ctx_cache:
+        n = RAG_DEFAULT_NUM_CTX
+        try:
+            r = await ollama_backends.send("chat", model, "POST", "/api/show", json={"model": model}, timeout=5)
+            if r.is_success:
+                m = re.search(r"^num_ctx\s+(\d+)", r.json().get("parameters") or "", re.MULTILINE)
+                if m:
+                    n = int(m.group(1))
+        except (httpx.HTTPError, ValueError):
+            pass  # not cached: retried on the next request
+        else:
+            _num_ctx_cache[model] = n
+        return n
+    return _num_ctx_cache[model]
+
+
+def _tokens(text: str) -> int:
+    return int(len(text) / RAG_CHARS_PER_TOKEN) + 1
+
+
+def _merge_text(a: str, b: str) -> str:
+    """Join consecutive chunks, dropping b's continuation label and the text both chunks share."""
+    b = _CONTINUATION_RE.sub("", b, count=1)
+    for k in range(min(len(a), len(b), RAG_MAX_OVERLAP_CHARS), 19, -1):
+        if a.endswith(b[:k]):
+            return a + b[k:]
+    return f"{a} {b}"
+
+
+def assemble_context(els: List[dict], budget_tokens: int) -> Tuple[List[dict], dict]:
+    """
+    Turn ranked chunks into numbered prompt sources: runs of adjacent chunk_index from the same file are
+    merged (overlap removed), duplicate text is dropped, and sources are packed in rank order until the
+    token budget is spent. Each source keeps its member chunks for the citations.
+    """
+    groups: "OrderedDict[Any, List[Tuple[int, dict]]]" = OrderedDict()
+    for rank, r in enumerate(els):
+        if not r.get("text"):
+            continue
+        key = r["id"] if r.get("via") == "reference" else (r.get("file_sha1") or r.get("source_name"))
+        groups.setdefault(key, []).append((rank, r))
+
+    sources: List[dict] = []
+    for members in groups.values():
+        members.sort(key=lambda m: (m[1].get("chunk_index") is None, m[1].get("chunk_index") or 0))
+        run: List[Tuple[int, dict]] = []
+        for rank, r in members:
+            prev = run[-1][1] if run else None
+            if prev is not None and prev.get("chunk_index") is not None and r.get("chunk_index") == prev["chunk_index"] + 1:
+                run.append((rank, r))
+                continue
+            if run:
+                sources.append(run)
+            run = [(rank, r)]
+        if run:
+            sources.append(run)
+
+    built = []
+    for run in sources:
+        text = run[0][1]["text"]
+        for _, r in run[1:]:
+            text = _merge_text(text, r["text"])
+        built.append({"rank": min(rank for rank, _ in run), "members": [r for _, r in run], "text": text})
+    built.sort(key=lambda src: src["rank"])
+
+    info = {"budget_tokens": budget_tokens, "used_tokens": 0, "chunks": len(els), "sources": 0,
+            "merged": 0, "duplicates": 0, "over_budget": 0, "truncated": 0}
+    kept: List[dict] = []
+    seen: List[str] = []
+    used = 0
+    for src in built:
+        norm = " ".join(src["text"].split())
+        if any(norm in other for other in seen):
+            info["duplicates"] += len(src["members"])
+            continue
+        cost = _tokens(src["text"]) + 4  # "[n] " marker and newline
+        if used + cost > budget_tokens:
+            room = budget_tokens - used - 4
+            if kept or room < 64:
+                info["over_budget"] += len(src["members"])
+                continue
+            # The best source alone is too large: keep its head rather than nothing
+            cut = src["text"][: int(room * RAG_CHARS_PER_TOKEN)]
+            src["text"] = cut[: cut.rfind(" ")] if " " in cut else cut
+            cost = _tokens(src["text"]) + 4
+            info["truncated"] += 1
+        seen.append(norm)
+        kept.append(src)
+        used += cost
+        info["merged"] += len(src["members"]) - 1
+    info.update(used_tokens=used, sources=len(kept))
+    return kept, info
+
+
+@staged("context")
+async def build_context(question: str, model: str, els: List[dict]) -> Tuple[List[dict], dict]:
+    """Numbered sources for the prompt, within num_ctx minus the prompt template and the answer reserve."""
+    num_ctx = await model_num_ctx(model)
+    overhead = _tokens(system_prompt(question, ""))
+    budget = max(256, num_ctx - RAG_ANSWER_TOKENS - overhead - 32)
+    sources, info = assemble_context(els, budget)
+    info["num_ctx"] = num_ctx
+    return sources, info
+
+
+# ——— Answer cache
+def _cosine(a: List[float], b: List[float], b_norm: float) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    a_norm = sum(x * x for x in a) ** 0.5
+    return dot / (a_norm * b_norm) if a_norm and b_norm else 0.0
+
+
+def _unit(vec: Optional[List[float]]) -> Optional[np.ndarray]:
+    """float32 unit vector (cosine = dot product), or None for a missing/zero vector."""
+    if vec is None:
+        return None
+    a = np.asarray(vec, dtype=np.float32)
+    norm = float(np.linalg.norm(a))
+    return a / norm if norm else None
+
+
+# Numbers (articles, CAS/EC numbers, tonnages) and roman-numbered Annex/Title references in a question
+_QUESTION_ID_RE = re.compile(r"\d+(?:[./-]\d+)*|\b(?:annex|title|chapter)\s+[ivxlc]+\b", re.IGNORECASE)
+
+
+def question_identifiers(question: str) -> List[str]:
+    """What a near-duplicate question must agree on: "Article 57" and "Article 58" embed almost identically."""
+    refs = {json.dumps(r, sort_keys=True) for r in parse_references(question)}
+    ids = {" ".join(m.lower().split()) for m in _QUESTION_ID_RE.findall(normalize_query(question))}
+    return sorted(refs | ids)
+
+
+class AnswerCache:
+    """
+    LRU + TTL cache of full /ask responses.
+
+    Exact hits are keyed on (model, prompt mode, temperature, normalized question, retrieved chunk ids +
+    text hashes), so a re-seed that changes chunk text never serves a stale answer. Near-duplicate hits
+    compare the question embedding against previously answered questions for the same (model, mode,
+    temperature) and skip retrieval entirely, so they also require the same cited references and numbers;
+    they are guarded by a collection version stamp (points count), which clears the cache when it changes.
+    """
+
+    def __init__(self, max_size: int, ttl: float, sim_threshold: float, stamp_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sim_threshold = sim_threshold
+        self.stamp_ttl = stamp_ttl
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.stamp: Optional[str] = None
+        self._stamp_checked = 0.0
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @staticmethod
+    def key(model: str, mode: str, temperature: float, question: str, els: List[dict]) -> str:
+        chunks = [
+            [str(r.get("id")), hashlib.sha1((r.get("text") or "").encode("utf-8")).hexdigest()]
+            for r in els
+        ]
+        # The question is part of the key: different questions over the same chunks need different answers
+        raw = json.dumps([model, mode, temperature, normalize_query(question), chunks], separators=(",", ":"))
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    async def sync_version(self) -> None:
+        """Re-read the collection version stamp (rate-limited) and drop everything if it moved."""
+        if not self.enabled or time.time() - self._stamp_checked < self.stamp_ttl:
+            return
+        self._stamp_checked = time.time()
+        try:
+            info = await qdrant.get_collection(collection_name=COLLECTION)
+        except Exception:
+            return  # keep serving; exact keys still protect against changed chunks
+        stamp = f"{COLLECTION}:{info.points_count}"
+        if self.stamp is not None and stamp != self.stamp:
+            self._entries.clear()
+            self.invalidations += 1
+        self.stamp = stamp
+
+    def _fresh(self, entry: dict) -> bool:
+        return (self.ttl <= 0 or time.time() - entry["created"] <= self.ttl) and entry["stamp"] == self.stamp
+
+    def get(self, key: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and self._fresh(entry):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def get_similar(self, vec: List[float], model: str, mode: str, temperature: float, question: str) -> Optional[dict]:
+        if not self.enabled or self.sim_threshold >= 1.0:
+            return None
+        q = _unit(vec)
+        if q is None:
+            return None
+        ids = question_identifiers(question)
+        candidates = [
+            e for e in self._entries.values()
+            if (e["model"], e["mode"], e["temperature"]) == (model, mode, temperature) and e["question_ids"] == ids
+            and e["question_unit"] is not None and e["question_unit"].shape == q.shape and self._fresh(e)
+        ]
+        if not candidates:
+            return None
+        # One matrix-vector product over pre-normalized vectors: cheap enough to stay on the event loop
+        sims = np.stack([e["question_unit"] for e in candidates]) @ q
+        i = int(np.argmax(sims))
+        best, best_sim = candidates[i], float(sims[i])
+        if best_sim < self.sim_threshold:
+            return None
+        self._entries.move_to_end(best["key"])
+        self.similar_hits += 1
+        return {**best, "similarity": round(best_sim, 4)}
+
+    def put(self, key: str, vec: Optional[List[float]], model: str, mode: str, temperature: float, question: str,
+            response: dict) -> None:
+        if not self.enabled:
+            return
+        self._entries[key] = {
+            "key": key,
+            "model": model,
+            "mode": mode,
+            "temperature": temperature,
+            "question_unit": _unit(vec),
+            "question_ids": question_identifiers(question),
+            "stamp": self.stamp,
+            "created": time.time(),
+            "response": response,
+        }
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.similar_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_s": self.ttl,
+            "similarity_threshold": self.sim_threshold,
+            "collection_stamp": self.stamp,
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": round((self.hits + self.similar_hits) / lookups, 4) if lookups else None,
+        }
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIM_THRESHOLD, ANSWER_CACHE_STAMP_TTL)
+
+
+class _Broadcast:
+    """
+    One event stream fanned out to any number of subscribers. Events are kept until the stream ends so
+    a late subscriber replays what it missed; the source is cancelled when the last subscriber leaves.
+    """
+
+    def __init__(self, source: AsyncGenerator[dict, None]):
+        self.events: List[dict] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source: AsyncGenerator[dict, None]) -> None:
+        try:
+            async for ev in source:
+                self.events.append(ev)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            await source.aclose()
+
+    def _notify(self) -> None:
+        self._wake.set()
+        self._wake = asyncio.Event()
+
+    async def subscribe(self, joined: bool) -> AsyncGenerator[dict, None]:
+        self.subscribers += 1
+        i = 0
+        try:
+            while True:
+                while i < len(self.events):
+                    ev = self.events[i]
+                    i += 1
+                    yield {**ev, "coalesced": True} if joined and ev["type"] == "done" else ev
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._wake.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self._task.done():
+                self._task.cancel()
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests: the first caller starts the work, later callers with the
+    same key wait for (or subscribe to) it. Entries are dropped as soon as the work finishes, so this
+    never serves stale results; completed answers are the answer cache's job.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._calls: Dict[tuple, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self._streams: Dict[tuple, _Broadcast] = {}
+        self.started = 0
+        self.joined = 0
+
+    def _forget(self, table: dict, key: tuple, entry: Any) -> None:
+        if table.get(key) is entry:
+            del table[key]
+
+    async def run(self, key: tuple, make) -> Tuple[Any, bool]:
+        """Result of make() for this key, shared with concurrent callers; (result, joined an in-flight call)."""
+        if not self.enabled:
+            self.started += 1
+            return await make(), False  # no sharing: a disconnect cancels the work as usual
+        task = self._calls.get(key)
+        joined = task is not None
+        if task is None:
+            task = asyncio.create_task(make())
+            self.started += 1
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(self._calls, key, t))
+        else:
+            self.joined += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # shield: a caller that disconnects must not cancel the work the others are waiting on
+            return await asyncio.shield(task), joined
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():  # last waiter left: nobody wants the result any more
+                    self._forget(self._calls, key, task)
+                    task.cancel()
+
+    def stream(self, key: tuple, make) -> AsyncGenerator[dict, None]:
+        """Events of make() for this key; concurrent callers share one source stream."""
+        bc = self._streams.get(key) if self.enabled else None
+        joined = bc is not None and not bc.done
+        if joined:
+            self.joined += 1
+        else:
+            bc = _Broadcast(make())
+            self.started += 1
+            if self.enabled:
+                self._streams[key] = bc
+                bc._task.add_done_callback(lambda _t: self._forget(self._streams, key, bc))
+        return bc.subscribe(joined)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls) + len(self._streams),
+            "started": self.started,
+            "joined": self.joined,
+        }
+
+
+single_flight = SingleFlight(RAG_COALESCE)
+
+# Registering runs collect() once, so this waits until every object it reads exists
+REGISTRY.register(_StatsCollector())
+
+
+def coalesce_key(kind: str, question: str, model: str, mode: str) -> tuple:
+    return (kind, model, normalize_query(question), mode, RAG_TEMPERATURE)
+
+
+def _cached_response(entry: dict, how: str) -> AskResponseRAG:
+    data = json.loads(json.dumps(entry["response"]))  # deep copy; callers may mutate
+    data["retrieval"]["cache"] = {"hit": how, "similarity": entry.get("similarity")}
+    if RAG_DEBUG:
+        data["retrieval"]["timings_ms"] = stage_timings()  # this request's, not the cached one's
+    return AskResponseRAG(**data)
+
+
+async def _replay(text: str) -> AsyncGenerator[str, None]:
+    """Re-emit a cached answer as a token-ish stream."""
+    for piece in re.findall(r"\S+\s*|\s+", text):
+        yield piece
+        await asyncio.sleep(0)
+
+
+def build_citations(sources: List[dict]) -> List[Citation]:
+    """One citation per numbered source; a merged source cites its first chunk and lists all of them."""
+    citations = []
+    for i, src in enumerate(sources, start=1):
+        first = src["members"][0]
+        indexes = [m["chunk_index"] for m in src["members"] if m.get("chunk_index") is not None]
+        citations.append(
+            Citation(
+                ref_num=i,
+                source_name=first.get("source_name"),
+                source_path=first.get("source_path"),
+                chunk_index=first.get("chunk_index"),
+                chunk_indexes=indexes if len(src["members"]) > 1 else None,
+                score=max(m["score"] for m in src["members"]),
+                excerpt=src["text"][:RAG_MAX_CHARS] if src.get("text") else None,
+                ref_label=next((m["ref_label"] for m in src["members"] if m.get("ref_label")), None),
+            )
+        )
+    return citations
+
+
+def _hybrid_block(results: List[dict]) -> dict:
+    """Which index each returned chunk came from (both = found by dense and sparse search)."""
+    dense = sum(1 for r in results if r.get("dense_rank") is not None)
+    sparse = sum(1 for r in results if r.get("sparse_rank") is not None)
+    both = sum(1 for r in results if r.get("dense_rank") is not None and r.get("sparse_rank") is not None)
+    return {
+        "mode": "hybrid" if sparse else "dense",
+        "rrf_k": RAG_RRF_K,
+        "candidates": RAG_HYBRID_CANDIDATES if RAG_HYBRID else RAG_TOP_K,
+        "dense_only": dense - both,
+        "sparse_only": sparse - both,
+        "both": both,
+    }
+
+
+def _retrieval_block(results: List[dict], used: int, rerank: Optional[dict] = None,
+                     context: Optional[dict] = None) -> dict:
+    return {
+        "top_k": RAG_TOP_K,
+        "min_score": RAG_MIN_SCORE,
+        "used": used,
+        "total_found": len(results),
+        "references": sum(1 for r in results if r.get("via") == "reference"),
+        "hybrid": _hybrid_block(results),
+        "rerank": rerank,
+        "context": context,
+        "raw": [{**r, "text": (r.get("text") or "")[:RAG_MAX_CHARS]} for r in results] if RAG_DEBUG else None,
+        "timings_ms": stage_timings() if RAG_DEBUG else None,
+    }
+
+
+async def call_ollama_nonstream(prompt: str, model: str) -> str:
     payload = {
         "model": model,
         "prompt": prompt,
         "stream": False,
-        "options": {"temperature": RAG_TEMPERATURE},
+        "keep_alive": residency.keep_alive(model),
+        "options": _gen_options(),
     }
-    return _ollama_nonstream(payload)
+    return await _ollama_nonstream(payload)
+
+
+async def gather_context(question: str, model: str, mode: str) -> Tuple[Optional[List[float]], Optional[dict], List[dict]]:
+    """
+    Retrieval shared by /ask and /ask_stream_rag: (question vector, near-duplicate cache hit, results).
+    Everything that only needs the question text (reference lookup, sparse search) runs while the
+    embedding is in flight. In "skip" mode a reference hit replaces vector search.
+    """
+    top_k = RERANK_CANDIDATES if reranker.enabled else RAG_TOP_K
+    embed_task = asyncio.create_task(embed_query(question))
+    sparse_task = asyncio.create_task(_sparse_search(question, _candidate_limit(top_k)))
+    try:
+        spans = await lookup_references(question)
+        if spans and RAG_REF_LOOKUP == "skip":
+            await answer_cache.sync_version()
+            return None, None, spans
+
+        # A near-duplicate of an answered question short-circuits retrieval and generation
+        vec = await embed_task
+        await answer_cache.sync_version()
+        hit = answer_cache.get_similar(vec, model, mode, RAG_TEMPERATURE, question)
+        if hit is not None:
+            return vec, hit, []
+        results = await retrieve(vec, question, top_k=top_k, sparse_hits=sparse_task)
+        return vec, None, merge_reference_hits(spans, results)
+    finally:
+        for task in (embed_task, sparse_task):
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # mark retrieved; the awaiting path already surfaced it
 
 
 @app.post("/ask", response_model=AskResponseRAG)
-def ask_rag(req: AskBase):
-    """RAG endpoint: when RAG_FORCE_ANSWER=true it will attempt best-effort answers with uncertainty markers."""
+async def ask_rag(req: AskBase, request: Request, response: Response):
+    """
+    RAG endpoint: when RAG_FORCE_ANSWER=true it will attempt best-effort answers with uncertainty markers.
+    Identical concurrent questions share one embedding, retrieval and generation.
+    """
     model = req.model or DEFAULT_MODEL
     question = req.prompt.strip()
-
-    # 1) Embed & retrieve
-    vec = embed_query(question)
-    results = retrieve(vec)
-    els = eligible(results)[:RAG_TOP_K]
+    mode = prompt_mode()
+    span = tracer.start_request("POST /ask", request.headers.get("traceparent"), model=model, mode=mode)
+    response.headers.update(trace_id_headers(span))
+    try:
+        with REQUESTS_IN_FLIGHT.labels("/ask").track_inprogress():
+            resp, joined = await single_flight.run(
+                coalesce_key("ask", question, model, mode), lambda: answer_rag(question, model, mode)
+            )
+    except BaseException as e:
+        tracer.end(span, e)
+        raise
+    # A joined request's stages are recorded in the trace of the request that ran them
+    tracer.annotate(coalesced=joined)
+    tracer.end(span)
+    if joined:
+        resp = resp.model_copy(deep=True)
+        resp.retrieval["coalesced"] = True
+    return resp
+
+
+async def answer_rag(question: str, model: str, mode: str) -> AskResponseRAG:
+    """The /ask pipeline for one question; stage timings go to /metrics (and the retrieval block in debug)."""
+    start_stage_timings()
+
+    # 1) Reference lookup / embed + retrieve (a near-duplicate answered question short-circuits);
+    #    the model loads in parallel
+    residency.warm(model)
+    vec, hit, results = await gather_context(question, model, mode)
+    if hit is not None:
+        return _cached_response(hit, "similar")
+    els, rerank_info = await select_context(question, results)
 
     # 2) Guardrail (strict mode only): no strong matches => refuse to answer
     if not RAG_FORCE_ANSWER and len([r for r in results if r["score"] >= RAG_MIN_SCORE]) < max(1, RAG_MIN_DOCS_REQUIRED):
@@ -344,109 +2464,266 @@ def ask_rag(req: AskBase):
             model=model,
             answer='I don\'t know based on the provided sources.',
             citations=[],
-            retrieval={
-                "top_k": RAG_TOP_K,
-                "min_score": RAG_MIN_SCORE,
-                "used": 0,
-                "total_found": len(results),
-                "raw": results if RAG_DEBUG else None,
-            },
+            retrieval=_retrieval_block(results, 0),
             policy={"answered": False, "reason": "no_relevant_documents_above_threshold"},
         )
 
-    # 3) Build prompt with numbered sources
-    sources_block = build_sources_block(els)
-    prompt = system_prompt(question, sources_block)
+    # 3) Same model/mode/temperature over the same chunks => same answer
+    cache_key = answer_cache.key(model, mode, RAG_TEMPERATURE, question, els)
+    hit = answer_cache.get(cache_key)
+    if hit is not None:
+        return _cached_response(hit, "exact")
 
-    # 4) Generate
-    answer = call_ollama_nonstream(prompt, model=model)
+    # 4) Build prompt with numbered sources (adjacent chunks merged, packed to the context window)
+    sources, context_info = await build_context(question, model, els)
+    sources_block = build_sources_block(sources)
+    prompt = system_prompt(question, sources_block)
 
-    # 5) Structure citations aligned with [^n]
-    cits: List[Citation] = []
-    for i, r in enumerate(els, start=1):
-        cits.append(
-            Citation(
-                ref_num=i,
-                source_name=r.get("source_name"),
-                source_path=r.get("source_path"),
-                chunk_index=r.get("chunk_index"),
-                score=r["score"],
-                excerpt=r.get("text"),
-            )
-        )
+    # 5) Generate (includes waiting for a generation slot)
+    with stage("generate"):
+        answer = await call_ollama_nonstream(prompt, model=model)
+    residency.touch(model)
 
-    return AskResponseRAG(
+    # 6) Structure citations aligned with [^n]
+    resp = AskResponseRAG(
         model=model,
         answer=answer,
-        citations=cits,
-        retrieval={
-            "top_k": RAG_TOP_K,
-            "min_score": RAG_MIN_SCORE,
-            "used": len(els),
-            "total_found": len(results),
-            "raw": results if RAG_DEBUG else None,
-        },
-        policy={"answered": True, "reason": "sufficient_retrieval" if els else "best_effort_with_uncertainty"},
+        citations=build_citations(sources),
+        retrieval=_retrieval_block(results, len(sources), rerank_info, context_info),
+        policy={"answered": True, "reason": "sufficient_retrieval" if sources else "best_effort_with_uncertainty"},
     )
+    answer_cache.put(cache_key, vec, model, mode, RAG_TEMPERATURE, question, resp.model_dump())
+    return resp
 
 
 # ——— Streaming RAG (keeps the same semantics)
-@app.post("/ask_stream_rag")
-def ask_stream_rag(req: AskBase):
+STREAM_MEDIA_TYPES = {"text": "text/plain", "sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+
+
+def stream_format(request: Request, requested: Optional[str]) -> str:
+    """?format=text|sse|ndjson wins; otherwise the Accept header picks SSE/NDJSON; plain text by default."""
+    if requested:
+        fmt = requested.lower()
+        if fmt not in STREAM_MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail=f"format must be one of {sorted(STREAM_MEDIA_TYPES)}")
+        return fmt
+    accept = request.headers.get("accept", "")
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    return "text"
+
+
+def event_stream_response(events: AsyncGenerator[dict, None], fmt: str) -> StreamingResponse:
     """
-    Streams text. If RAG_FORCE_ANSWER is False and retrieval is weak, yields the no-answer line and stops.
+    Encode RAG stream events. Structured formats carry every event ({"type": "meta" | "delta" | "done" |
+    "error", ...}); plain text keeps the old behaviour of bare deltas plus an inline error marker.
     """
-    model = req.model or DEFAULT_MODEL
-    question = req.prompt.strip()
 
-    # Retrieval first (non-streaming paths)
-    vec = embed_query(question)
-    results = retrieve(vec)
-    els = eligible(results)[:RAG_TOP_K]
+    async def encode() -> AsyncGenerator[str, None]:
+        async for ev in _errors_as_events(events):
+            if fmt == "sse":
+                yield f"event: {ev['type']}\ndata: {json.dumps(ev, ensure_ascii=False)}\n\n"
+            elif fmt == "ndjson":
+                yield json.dumps(ev, ensure_ascii=False) + "\n"
+            elif ev["type"] == "delta":
+                yield ev["text"]
+            elif ev["type"] == "error":
+                yield f"\n[stream error: {ev['detail']}]"
 
-    if not RAG_FORCE_ANSWER and len([r for r in results if r["score"] >= RAG_MIN_SCORE]) < max(1, RAG_MIN_DOCS_REQUIRED):
-        return StreamingResponse(iter(["I don't know based on the provided sources."]), media_type="text/plain")
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} if fmt != "text" else None
+    return StreamingResponse(encode(), media_type=STREAM_MEDIA_TYPES[fmt], headers=headers)
+
+
+async def _errors_as_events(events: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    # Once the response has started, an upstream failure can only be reported in-stream
+    try:
+        async for ev in events:
+            yield ev
+    except HTTPException as e:
+        ev = {"type": "error", "detail": e.detail, "status_code": e.status_code}
+        if e.headers and "Retry-After" in e.headers:
+            ev["retry_after"] = int(e.headers["Retry-After"])
+        yield ev
+
+
+def _meta_event(resp: dict) -> dict:
+    return {"type": "meta", **{k: resp[k] for k in ("model", "citations", "retrieval", "policy")}}
+
+
+def _done_event(t0: float, timing: dict, final: Optional[dict] = None) -> dict:
+    """Timing (ms, server side) and Ollama's token counts from the final NDJSON object, when there is one."""
+    final = final or {}
+    ev: Dict[str, Any] = {"type": "done", "timing": {**timing, "total_ms": round((time.perf_counter() - t0) * 1000, 1)}}
+    for key in ("prompt_eval_count", "eval_count"):
+        if key in final:
+            ev[key] = final[key]
+    for key in ("load_duration", "prompt_eval_duration", "eval_duration"):
+        if key in final:
+            ev[f"{key}_ms"] = round(final[key] / 1e6, 1)
+    if final.get("eval_count") and final.get("eval_duration"):
+        ev["tokens_per_s"] = round(final["eval_count"] / (final["eval_duration"] / 1e9), 2)
+    if RAG_DEBUG:
+        ev["stages_ms"] = stage_timings()
+    return ev
+
+
+async def _static_events(resp: dict, t0: float, timing: dict) -> AsyncGenerator[dict, None]:
+    """Events for an answer that already exists (cache hit or refusal): meta, replayed deltas, done."""
+    yield _meta_event(resp)
+    async for piece in _replay(resp["answer"]):
+        yield {"type": "delta", "text": piece}
+    yield _done_event(t0, timing)
+
+
+async def rag_stream_events(question: str, model: str, mode: str, t0: float) -> AsyncGenerator[dict, None]:
+    """
+    The streaming RAG flow as events: status (sent before any work), meta, deltas, done. The model is
+    warmed up while retrieval runs. Retrieval failures propagate as HTTPException.
+    """
+    timing: Dict[str, Any] = {}
+    start_stage_timings()
+    warmup = residency.warm(model)
+    timing["ttfb_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    yield {"type": "status", "stage": "retrieving", "warmup": warmup}
+
+    vec, hit, results = await gather_context(question, model, mode)
+    if hit is not None:
+        async for ev in _static_events(_cached_response(hit, "similar").model_dump(), t0, timing):
+            yield ev
+        return
+    els, rerank_info = await select_context(question, results)
+    timing["retrieval_ms"] = round((time.perf_counter() - t0) * 1000, 1)
 
-    sources_block = build_sources_block(els)
+    if not RAG_FORCE_ANSWER and len([r for r in results if r["score"] >= RAG_MIN_SCORE]) < max(1, RAG_MIN_DOCS_REQUIRED):
+        resp = AskResponseRAG(
+            model=model,
+            answer="I don't know based on the provided sources.",
+            citations=[],
+            retrieval=_retrieval_block(results, 0),
+            policy={"answered": False, "reason": "no_relevant_documents_above_threshold"},
+        ).model_dump()
+        async for ev in _static_events(resp, t0, timing):
+            yield ev
+        return
+
+    cache_key = answer_cache.key(model, mode, RAG_TEMPERATURE, question, els)
+    hit = answer_cache.get(cache_key)
+    if hit is not None:
+        async for ev in _static_events(_cached_response(hit, "exact").model_dump(), t0, timing):
+            yield ev
+        return
+
+    sources, context_info = await build_context(question, model, els)
+    sources_block = build_sources_block(sources)
     sprompt = system_prompt(question, sources_block)
 
     payload = {
         "model": model,
         "prompt": sprompt,
         "stream": True,  # explicit streaming for NDJSON
-        "options": {"temperature": RAG_TEMPERATURE},
+        "keep_alive": residency.keep_alive(model),
+        "options": _gen_options(),
     }
+    # Everything but the answer is known before generation starts; it goes out first
+    resp = AskResponseRAG(
+        model=model,
+        answer="",
+        citations=build_citations(sources),
+        retrieval=_retrieval_block(results, len(sources), rerank_info, context_info),
+        policy={"answered": True, "reason": "sufficient_retrieval" if sources else "best_effort_with_uncertainty"},
+    )
+    # Admission happens before meta, so a plain-text stream still gets a real 429/503 under overload
+    t_gen = time.perf_counter()
+    with tracer.span("generate"):
+        async with gen_scheduler.slot(model, gen_priority(payload)):
+            timing["queue_ms"] = round((time.perf_counter() - t_gen) * 1000, 1)
+            yield _meta_event(resp.model_dump())
+            yield {"type": "status", "stage": "generating"}
+
+            parts: List[str] = []
+            try:
+                async for j in _ollama_stream_events(payload):
+                    if j.get("response"):
+                        if not parts:
+                            timing["ttft_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+                        parts.append(j["response"])
+                        yield {"type": "delta", "text": j["response"]}
+                    if j.get("done"):
+                        # Includes the slot wait, as in /ask; the trace span stays open until the stream closes
+                        _observe_stage("generate", time.perf_counter() - t_gen)
+                        # Only complete generations are cached (same shape as /ask)
+                        residency.touch(model)
+                        resp.answer = "".join(parts).strip()
+                        answer_cache.put(cache_key, vec, model, mode, RAG_TEMPERATURE, question, resp.model_dump())
+                        yield _done_event(t0, timing, j)
+            except httpx.HTTPError as e:
+                yield {"type": "error", "detail": str(e)}
+
+
+async def _track_stream(endpoint: str, span: Optional[dict], events: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    # A stream is in flight (and its server span open) until its last event, not until the handler returns
+    error: Optional[BaseException] = None
+    try:
+        with REQUESTS_IN_FLIGHT.labels(endpoint).track_inprogress():
+            async for ev in events:
+                if ev["type"] == "error":
+                    error = RuntimeError(ev.get("detail"))
+                yield ev
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        tracer.end(span, error)
 
-    def gen() -> Generator[str, None, None]:
-        try:
-            with requests.post(
-                f"{OLLAMA_URL}/api/generate",
-                json=payload,
-                stream=True,
-                timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT),
-            ) as r:
-                r.raise_for_status()
-                for line in r.iter_lines(decode_unicode=True):
-                    if not line:
-                        continue
-                    try:
-                        j = json.loads(line)
-                        if "response" in j and j["response"]:
-                            yield j["response"]
-                        if j.get("done"):
-                            break
-                    except json.JSONDecodeError:
-                        # Pass-through any occasional non-JSON line
-                        yield line
-        except requests.exceptions.RequestException as e:
-            yield f"\n[stream error: {e}]"
-
-    return StreamingResponse(gen(), media_type="text/plain")
+
+async def _prepend(first: List[dict], rest: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    for ev in first:
+        yield ev
+    async for ev in rest:
+        yield ev
+
+
+@app.post("/ask_stream_rag")
+async def ask_stream_rag(req: AskBase, request: Request, fmt: Optional[str] = Query(None, alias="format")):
+    """
+    Streams the answer. Plain text (default) yields bare tokens. With ?format=sse|ndjson (or a matching
+    Accept header) it yields structured events right away: status ("retrieving", then "generating"),
+    meta (citations, retrieval, policy), delta tokens, and a final done event with TTFB/TTFT, timings and
+    token counts.
+    If RAG_FORCE_ANSWER is False and retrieval is weak, yields the no-answer line and stops.
+    Cached answers (exact or near-duplicate) are replayed as a stream. Concurrent identical questions
+    share one stream (late joiners replay it from the start; their done event says "coalesced").
+    """
+    fmt = stream_format(request, fmt)
+    t0 = time.perf_counter()
+    model = req.model or DEFAULT_MODEL
+    question = req.prompt.strip()
+    mode = prompt_mode()
+    span = tracer.start_request("POST /ask_stream_rag", request.headers.get("traceparent"), model=model, mode=mode, format=fmt)
+    # Identical concurrent questions are fanned out from one pipeline and one /api/generate stream
+    events = single_flight.stream(
+        coalesce_key("stream", question, model, mode), lambda: rag_stream_events(question, model, mode, t0)
+    )
+    events = _track_stream("/ask_stream_rag", span, events)
+    if fmt == "text":
+        # Plain text cannot show early events: finish retrieval before the response starts so that
+        # failures stay HTTP errors, as before
+        head: List[dict] = []
+        async for ev in events:
+            head.append(ev)
+            if ev["type"] != "status":
+                break
+        events = _prepend(head, events)
+    resp = event_stream_response(events, fmt)
+    resp.headers.update(trace_id_headers(span))
+    return resp
 
 
 # ——— Qdrant debug helpers
 @app.post("/qdrant_scroll")
-def qdrant_scroll(body: dict = Body(...)):
+async def qdrant_scroll(body: dict = Body(...)):
     """
     Inspect Qdrant: returns a small sample of payloads.
     Body accepts: limit, with_payload, with_vectors, filter (dict), offset (dict).
@@ -474,7 +2751,7 @@ def qdrant_scroll(body: dict = Body(...)):
         if not isinstance(offset, dict):
             offset = None
 
-        points, next_off = qdrant.scroll(
+        points, next_off = await qdrant.scroll(
             collection_name=COLLECTION,
             limit=limit,
             with_payload=with_payload,
@@ -495,7 +2772,7 @@ def qdrant_scroll(body: dict = Body(...)):
 
 
 @app.post("/qdrant_counts_by_source")
-def qdrant_counts_by_source():
+async def qdrant_counts_by_source():
     """
     Returns [{source_name, count}] for up to the whole collection (batched scroll).
     """
@@ -504,7 +2781,7 @@ def qdrant_counts_by_source():
     agg = collections.Counter()
     next_off = None
     while True:
-        points, next_off = qdrant.scroll(
+        points, next_off = await qdrant.scroll(
             collection_name=COLLECTION,
             limit=1000,
             offset=next_off,
@@ -521,23 +2798,17 @@ def qdrant_counts_by_source():
 
 # ——— NEW: Retrieve-only endpoint (proves retrieval is working without the LLM)
 @app.get("/debug/retrieve")
-def debug_retrieve(qtext: str, top_k: int = 10):
+async def debug_retrieve(qtext: str, top_k: int = 10):
     """
     Embeds qtext via Ollama and directly queries Qdrant. Ignores score thresholds.
     Returns id-less summaries suitable for debugging.
     """
     try:
-        # embed
-        er = requests.post(
-            f"{OLLAMA_URL}/api/embeddings",
-            json={"model": EMBED_MODEL, "prompt": qtext},
-            timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT),
-        )
-        er.raise_for_status()
-        vec = er.json()["embedding"]
+        # embed (shares the query-embedding cache with /ask)
+        vec = await embed_query(qtext)
 
         # search
-        hits = qdrant.search(collection_name=COLLECTION, query_vector=vec, limit=top_k, with_payload=True)
+        hits = await qdrant.search(collection_name=COLLECTION, query_vector=vec, limit=top_k, with_payload=True)
         out = []
         for h in hits:
             p = h.payload or {}
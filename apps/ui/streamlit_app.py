@@ -1,6 +1,7 @@
 # apps/ui/streamlit_app.py
 import os
 import json
+import secrets
 import requests
 import streamlit as st
 
@@ -97,7 +98,9 @@ def render_answer_payload(res: dict):
     st.markdown(f"**Model:** `{res.get('model','')}`")
     st.write("### Answer")
     st.write(res.get("answer", ""))
+    render_sources(res)
 
+def render_sources(res: dict):
     st.write("### Citations")
     cits = res.get("citations", [])
     if not cits:
@@ -107,9 +110,11 @@ def render_answer_payload(res: dict):
         if not shown:
             st.caption(f"No citations above client filter: min_score={min_score:.2f}")
         for c in shown:
+            idx = c.get("chunk_indexes") or [c.get("chunk_index")]
+            chunks = f"chunk {idx[0]}" if len(idx) == 1 else f"chunks {idx[0]}-{idx[-1]}"
             st.markdown(
                 f"[^{c.get('ref_num')}] **{c.get('source_name','')}** "
-                f"(chunk {c.get('chunk_index')}, score {c.get('score',0):.3f})  \n"
+                f"({chunks}, score {c.get('score',0):.3f})  \n"
                 f"`{c.get('source_path','')}`"
             )
             ex = c.get("excerpt")
@@ -132,50 +137,108 @@ def api_headers():
         "Content-Type": "application/json",
     }
 
+def new_traceparent():
+    # W3C trace context: the API continues this trace, so one question can be followed across services
+    return f"00-{secrets.token_hex(16)}-{secrets.token_hex(8)}-01"
+
 def api_params():
     # Informative query param—safe no-op if server ignores it.
     return {"force_answer": "true" if force_answer_wanted else "false"}
 
+def iter_stream_events(r):
+    # NDJSON: one event object per line (status, meta, delta..., done | error)
+    for line in r.iter_lines(decode_unicode=True):
+        if line:
+            yield json.loads(line)
+
+def busy_message(status_code, retry_after):
+    # 429 = generation queue full, 503 = waited too long for a slot
+    what = "busy" if status_code == 429 else "overloaded"
+    return f"Server is {what}; try again in {retry_after or 'a few'} s."
+
+def render_answer_stream(r):
+    """Render /ask_stream_rag events: header from meta, tokens appended as they arrive, timings from done."""
+    events = iter_stream_events(r)
+    status = st.empty()
+    res = {}
+    for ev in events:
+        if ev.get("type") == "status":
+            status.caption(f"{ev.get('stage', '').capitalize()}…")
+        elif ev.get("type") == "error":
+            status.empty()
+            if ev.get("status_code") in (429, 503):
+                st.warning(busy_message(ev["status_code"], ev.get("retry_after")))
+            else:
+                st.error(f"Stream error: {ev.get('detail')}")
+            return
+        elif ev.get("type") == "meta":
+            res = ev
+            break
+    render_server_mode_banner(res)
+    st.markdown(f"**Model:** `{res.get('model','')}`")
+    st.write("### Answer")
+    done = {}
+
+    def deltas():
+        for ev in events:
+            if ev.get("type") == "status":
+                status.caption(f"{ev.get('stage', '').capitalize()}…")
+            elif ev.get("type") == "delta":
+                status.empty()
+                yield ev.get("text", "")
+            elif ev.get("type") == "done":
+                done.update(ev)
+            elif ev.get("type") == "error":
+                st.error(f"Stream error: {ev.get('detail')}")
+
+    res["answer"] = st.write_stream(deltas())
+    if done:
+        t = done.get("timing", {})
+        tps = f" · {done['tokens_per_s']} tok/s" if done.get("tokens_per_s") else ""
+        st.caption(f"retrieval {t.get('retrieval_ms')} ms · first byte {t.get('ttfb_ms')} ms · first token {t.get('ttft_ms', '–')} ms · "
+                   f"total {t.get('total_ms')} ms · {done.get('eval_count', '–')} tokens{tps}")
+    render_sources(res)
+
 if ask_btn:
     if not prompt.strip():
         st.warning("Please enter a prompt.")
     else:
+        traceparent = new_traceparent()
         try:
             if use_stream:
                 with st.spinner("Thinking…"):
                     r = requests.post(
                         f"{API_URL}/ask_stream_rag",
-                        params=api_params(),
-                        headers=api_headers(),
+                        params={**api_params(), "format": "ndjson"},
+                        headers={**api_headers(), "traceparent": traceparent},
                         json={"prompt": prompt, "model": model, "temperature": temperature},
                         stream=True,
                         timeout=(10, int(timeout_s)),
                     )
                     if r.status_code == 404:
                         st.error("`/ask_stream_rag` not found on API. Disable Stream or update API.")
+                    elif r.status_code in (429, 503):
+                        st.warning(busy_message(r.status_code, r.headers.get("Retry-After")))
                     else:
                         r.raise_for_status()
-                        ph = st.empty()
-                        buf = []
-                        for chunk in r.iter_content(chunk_size=None, decode_unicode=True):
-                            if not chunk:
-                                continue
-                            buf.append(chunk)
-                            ph.markdown("".join(buf))
+                        render_answer_stream(r)
             else:
                 with st.spinner("Thinking…"):
                     r = requests.post(
                         f"{API_URL}/ask",
                         params=api_params(),
-                        headers=api_headers(),
+                        headers={**api_headers(), "traceparent": traceparent},
                         json={"prompt": prompt, "model": model, "temperature": temperature},
                         timeout=int(timeout_s),
                     )
+                if r.status_code in (429, 503):
+                    st.warning(busy_message(r.status_code, r.headers.get("Retry-After")))
+                else:
                     r.raise_for_status()
-                    res = r.json()
-                render_answer_payload(res)
+                    render_answer_payload(r.json())
         except Exception as e:
             st.error(f"Request error: {e}")
+        st.caption(f"trace id `{traceparent.split('-')[1]}`")
 
 st.caption("In strict server mode, answers are given ONLY from retrieved sources; otherwise the server replies “I don't know based on the provided sources.” In relaxed mode, the server may answer with uncertainty if context is thin.")
 
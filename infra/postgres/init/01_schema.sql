@@ -6,7 +6,9 @@ CREATE TABLE IF NOT EXISTS documents (
   doc_type TEXT,
   lang TEXT DEFAULT 'en',
   date DATE,
-  hash TEXT
+  hash TEXT,
+  source_name TEXT,
+  spans_sha1 TEXT
 );
 CREATE TABLE IF NOT EXISTS spans (
   span_id SERIAL PRIMARY KEY,
@@ -17,7 +19,9 @@ CREATE TABLE IF NOT EXISTS spans (
   paragraph TEXT,
   text TEXT NOT NULL,
   start_char INT,
-  end_char INT
+  end_char INT,
+  chunk_index INT
 );
 CREATE INDEX IF NOT EXISTS idx_spans_ref_label ON spans(ref_label);
 CREATE INDEX IF NOT EXISTS idx_spans_article_para ON spans(article, paragraph);
+CREATE INDEX IF NOT EXISTS idx_documents_celex ON documents(celex);
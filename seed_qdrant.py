@@ -2,9 +2,20 @@ import os
 import time
 import hashlib
 import re
-from typing import List, Set, Optional
+import queue
+import sqlite3
+import threading
+import unicodedata
+import zlib
+import urllib.parse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Set, Optional, Tuple
 
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from qdrant_client import QdrantClient
 from qdrant_client.http import models as qmodels
 
@@ -15,7 +26,9 @@ except ImportError:  # pragma: no cover
     class tqdm:  # minimal shim
         def __init__(self, iterable=None, total=None, desc=None, unit=None):
             self.iterable = iterable
+            self.total = total
         def update(self, n=1): pass
+        def refresh(self): pass
         def close(self): pass
         def set_description(self, *_args, **_kwargs): pass
         def __iter__(self):
@@ -31,23 +44,93 @@ EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")   # 768-d
 COLLECTION = os.getenv("QDRANT_COLLECTION", "regdocs_v1")
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1200"))            # ~ characters
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+# "structure": split on Article/paragraph/Annex/section boundaries and pack up to CHUNK_TOKENS (no overlap)
+# "fixed": CHUNK_SIZE-char windows with CHUNK_OVERLAP (previous behaviour)
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "structure").lower()
+CHARS_PER_TOKEN = 4  # rough estimate for EU legal English
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", str(CHUNK_SIZE // CHARS_PER_TOKEN)))
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "64"))
 # Optional: cap pages for problematic PDFs (0 = no cap)
 MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "0"))
-# Resume: skip already-present chunks (by file_sha1 + chunk_index)
+# Resume: skip unchanged chunks (file_sha1 + chunk_index + chunk_sha1), reuse vectors of identical text
 RESUME = os.getenv("RESUME", "true").lower() == "true"
 # Simple retries for Ollama embeddings
 EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "3"))
 EMBED_RETRY_BACKOFF = float(os.getenv("EMBED_RETRY_BACKOFF", "1.5"))
+# Batched embeddings via /api/embed (array input); 1 = legacy one-chunk-per-call /api/embeddings
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))       # starting batch size
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "256"))
+EMBED_BATCH_TARGET_SECONDS = float(os.getenv("EMBED_BATCH_TARGET_SECONDS", "8"))  # adapt size toward this latency
+EMBED_BATCH_TIMEOUT = int(os.getenv("EMBED_BATCH_TIMEOUT", "600"))
+# Pipeline: extraction processes -> embedding threads -> one Qdrant writer, joined by bounded queues
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", os.getenv("OLLAMA_NUM_PARALLEL", "2")))  # match Ollama's parallelism
+PIPELINE_QUEUE_DEPTH = int(os.getenv("PIPELINE_QUEUE_DEPTH", "8"))  # batches buffered between stages
+# Up-front total estimate (refined as files are chunked); only drives the progress bar/ETA
+EST_CHARS_PER_PDF_PAGE = int(os.getenv("EST_CHARS_PER_PDF_PAGE", "3000"))
+TXT_READ_BLOCK = 1 << 20
+# PDF pages are extracted in blocks across the process pool and cached per (file_sha1, page)
+PDF_PAGE_BLOCK = int(os.getenv("PDF_PAGE_BLOCK", "8"))
+PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH", "./.cache/pdf_pages.sqlite3")  # "" disables
+# Hybrid retrieval: a BM25-style sparse vector per chunk next to the dense one (Qdrant applies IDF)
+SPARSE_INDEX = os.getenv("SPARSE_INDEX", "true").lower() == "true"
+SPARSE_VECTOR_NAME = os.getenv("SPARSE_VECTOR_NAME", "bm25")
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+BM25_AVG_TOKENS = float(os.getenv("BM25_AVG_TOKENS", "180"))  # typical chunk length in terms
+# documents/spans rows for CELEX regulations (API exact-reference lookup); needs DATABASE_URL + structure chunking
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+SPANS_INGEST = os.getenv("SPANS_INGEST", "true").lower() == "true"
+# Pooled keep-alive HTTP (same knobs as the API)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))      # keep-alive connections kept per host
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
 # ----------------------------
 
+def make_http_session() -> requests.Session:
+    """Keep-alive session with per-host pools and connection/5xx retry with backoff."""
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        read=0,  # never re-send after the server started working on it
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=None,  # embeddings are POST but idempotent
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=4,  # distinct hosts we talk to (Ollama, Qdrant)
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+    s = requests.Session()
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+http_session = make_http_session()
+
+def qdrant_http_limits() -> httpx.Limits:
+    # qdrant-client disables keep-alive for localhost unless limits are given explicitly
+    return httpx.Limits(max_connections=None, max_keepalive_connections=HTTP_POOL_SIZE)
+
 # --- Helpers ---
 
-def read_text_from_file(path: str) -> str:
+def pdf_page_limit(total_pages: int) -> int:
+    if MAX_PDF_PAGES and total_pages > MAX_PDF_PAGES:
+        return MAX_PDF_PAGES  # soft cap if you set it via env
+    return total_pages
+
+def iter_text_fragments(path: str, progress: bool = True) -> Iterator[str]:
+    """
+    Yield the raw text of a file in pieces (PDF pages separated by "\n", TXT in 1 MiB blocks).
+    Concatenating the pieces gives exactly what read_text_from_file returns.
+    """
     lower = path.lower()
     if lower.endswith(".txt"):
         with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()
+            for block in iter(lambda: f.read(TXT_READ_BLOCK), ""):
+                yield block
+        return
 
     if lower.endswith(".pdf"):
         try:
@@ -56,28 +139,31 @@ def read_text_from_file(path: str) -> str:
             raise RuntimeError("pypdf is required for PDFs. Install with: pip install pypdf") from e
 
         reader = PdfReader(path)
-        total_pages = len(reader.pages)
-        n_pages = total_pages
-        if MAX_PDF_PAGES and total_pages > MAX_PDF_PAGES:
-            n_pages = MAX_PDF_PAGES  # soft cap if you set it via env
-
-        texts = []
-        bar = tqdm(range(n_pages), desc=f"PDF read: {os.path.basename(path)}", unit="page")
-        for i in bar:
+        n_pages = pdf_page_limit(len(reader.pages))
+
+        pages = range(n_pages)
+        if progress:
+            pages = tqdm(pages, desc=f"PDF read: {os.path.basename(path)}", unit="page")
+        for i in pages:
             try:
                 page = reader.pages[i]
                 t = page.extract_text() or ""
             except Exception:
                 t = ""  # skip unreadable page but keep going
-            texts.append(t)
-        return "\n".join(texts)
+            if i:
+                yield "\n"
+            yield t
+        return
 
     raise RuntimeError(f"Unsupported file type: {path}")
 
+def read_text_from_file(path: str, progress: bool = True) -> str:
+    return "".join(iter_text_fragments(path, progress))
+
 def normalize_ws(s: str) -> str:
     return re.sub(r"\s+", " ", s).strip()
 
-def chunk_text(text: str, size: int, overlap: int) -> List[str]:
+def _check_chunk_params(size: int, overlap: int):
     if size <= 0:
         raise ValueError("CHUNK_SIZE must be > 0")
     if overlap < 0:
@@ -86,6 +172,9 @@ def chunk_text(text: str, size: int, overlap: int) -> List[str]:
         # Overlap must be strictly smaller than size to make forward progress
         raise ValueError("CHUNK_OVERLAP must be < CHUNK_SIZE")
 
+def chunk_text(text: str, size: int, overlap: int) -> List[str]:
+    _check_chunk_params(size, overlap)
+
     text = normalize_ws(text)
     chunks = []
     n = len(text)
@@ -100,6 +189,429 @@ def chunk_text(text: str, size: int, overlap: int) -> List[str]:
 
     return chunks
 
+def iter_chunks(fragments: Iterable[str], size: int, overlap: int) -> Iterator[str]:
+    """
+    Streaming chunk_text: yields the same chunks as chunk_text("".join(fragments), ...) while only
+    holding the not-yet-chunked tail of the normalized text in memory.
+    """
+    _check_chunk_params(size, overlap)
+
+    buf = ""
+    started = False        # emitted any non-space text yet (leading whitespace is stripped)
+    pending_space = False  # whitespace seen since the last word
+    for frag in fragments:
+        if not frag:
+            continue
+        words = frag.split()
+        if not words:
+            pending_space = True
+            continue
+        if started and (pending_space or frag[0].isspace()):
+            buf += " "
+        buf += " ".join(words)
+        started = True
+        pending_space = frag[-1].isspace()
+
+        # Emit every window that provably is not the last one
+        start = 0
+        while start + size < len(buf):
+            yield buf[start:start + size]
+            start += size - overlap
+        buf = buf[start:]
+
+    n = len(buf)
+    start = 0
+    while start < n:
+        end = min(start + size, n)
+        yield buf[start:end]
+        if end == n:
+            break
+        start = end - overlap
+
+def count_pdf_pages(path: str) -> int:
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("pypdf is required for PDFs. Install with: pip install pypdf") from e
+    return pdf_page_limit(len(PdfReader(path).pages))
+
+# --- Structure-aware chunking (CELEX regulations, ECHA guidance) ---
+
+CELEX_LABELS = {
+    "32006R1907": "REACH",
+    "32012R0528": "BPR",
+    "32008R1272": "CLP",
+}
+
+_ARTICLE_RE = re.compile(r"^Article\s+(\d+[a-z]?)$")
+_ANNEX_RE = re.compile(r"^ANNEX\s+([IVXLC]+[a-z]?)\b(?:\s+[A-Z].{0,120})?$")
+_PART_RE = re.compile(r"^(TITLE|CHAPTER)\s+([IVXLC]+|\d+)\b")
+_PARAGRAPH_RE = re.compile(r"^(\d{1,3})\.\s+\S")
+_SECTION_RE = re.compile(r"^(\d{1,2}(?:\.\d{1,2}){1,3})\.?\s+[A-Z(][^.]{2,120}$|^(\d{1,2})\.?\s+[A-Z][A-Z ,&/-]{3,80}$")
+_BOILERPLATE_RE = re.compile(r"Official Journal of the European Union|^\d{1,4}$|^\(?\d+\)?\s*OJ\s")
+# Table-of-contents lines: dot leaders ending in a page number, and the "Contents" title itself
+_TOC_LINE_RE = re.compile(r"(?:\.\s?|\u2026\s?){4,}\s*\d+$|^(?:table\s+of\s+)?contents$", re.IGNORECASE)
+_TOC_PAGE_RE = re.compile(r"^.{20,}\D\s\d{1,4}$")  # inside a TOC: an entry ending in its page number
+_HEADING_KINDS = ("part", "article", "annex", "section")
+HEADING_MAX_CHARS = 250  # a heading-only unit longer than this is kept as text rather than dropped
+_SENTENCE_RE = re.compile(r"(?<=[.;:])\s+(?=[A-Z(\d])")
+
+def doc_celex(path: str) -> Optional[str]:
+    m = re.search(r"CELEX:(\d{5}[A-Z]\d{4})", urllib.parse.unquote(os.path.basename(path)))
+    return m.group(1) if m else None
+
+def doc_label(path: str) -> str:
+    """Short document name used in ref labels: REACH/BPR/... for known CELEX numbers, else the file stem."""
+    celex = doc_celex(path)
+    if celex:
+        return CELEX_LABELS.get(celex, celex)
+    return os.path.splitext(urllib.parse.unquote(os.path.basename(path)))[0]
+
+def ref_label(doc: str, article: Optional[str], paragraph: Optional[str], annex: Optional[str],
+              section: Optional[str]) -> str:
+    if article:
+        return f"{doc} Art.{article}" + (f"({paragraph})" if paragraph else "")
+    if annex:
+        return f"{doc} Annex {annex}" + (f"({paragraph})" if paragraph else "")
+    if section:
+        return f"{doc} §{section}"
+    return doc
+
+def iter_lines(fragments: Iterable[str]) -> Iterator[str]:
+    """Re-split streamed fragments into complete lines."""
+    tail = ""
+    for frag in fragments:
+        if not frag:
+            continue
+        parts = (tail + frag).split("\n")
+        tail = parts.pop()
+        yield from parts
+    if tail:
+        yield tail
+
+def iter_units(lines: Iterable[str]) -> Iterator[dict]:
+    """
+    Group lines into structural units: an Article (or Annex) heading, each numbered paragraph inside it,
+    TITLE/CHAPTER headings and numbered guidance sections. Page headers/footers and TOC lines are dropped.
+    Units holding nothing but a heading are flagged "heading"; those met in a table of contents also "toc".
+    """
+    state = {"article": None, "paragraph": None, "annex": None, "section": None}
+    buf: List[str] = []
+    kind = "body"  # what opened the current unit: part/article/annex/paragraph/section/body
+    toc: Optional[dict] = None  # inside a table of contents: the location before it
+    list_n: Optional[int] = None  # last item number of a numbered list running inside the current paragraph
+
+    def flush():
+        nonlocal toc
+        text = normalize_ws(" ".join(buf))
+        buf.clear()
+        if not text:
+            return None
+        heading = kind in _HEADING_KINDS and not text.endswith((".", ";", ":"))
+        unit = {**state, "text": text, "kind": kind, "heading": heading, "toc": heading and toc is not None}
+        if not heading:
+            toc = None  # body text: the table of contents is over
+        return unit
+
+    for raw in lines:
+        line = raw.strip()
+        if not line or _BOILERPLATE_RE.search(line):
+            continue
+        if _TOC_LINE_RE.search(line) or (toc is not None and _TOC_PAGE_RE.search(line)):
+            if toc is None:
+                unit = flush()
+                if unit:
+                    yield unit
+                toc = dict(state)
+            # The line closes a TOC entry, possibly wrapped over the lines before it: drop them too
+            buf.clear()
+            state.update(toc)
+            kind = "body"
+            continue
+        m_art = _ARTICLE_RE.match(line)
+        m_anx = None if m_art else _ANNEX_RE.match(line)
+        m_part = None if (m_art or m_anx) else _PART_RE.match(line)
+        m_par = None
+        if not (m_art or m_anx or m_part) and (state["article"] or state["annex"]):
+            m_par = _PARAGRAPH_RE.match(line)
+            if m_par:
+                # A paragraph number must follow on from the current one; "1." inside a paragraph opens a
+                # numbered list (e.g. the SDS headings in REACH Art. 31(6)), whose items win a tie
+                n = int(m_par.group(1))
+                cur = state["paragraph"]
+                if list_n is not None and n == list_n + 1:
+                    list_n, m_par = n, None
+                elif (cur is None and n <= 1) or (cur is not None and n == int(cur) + 1):
+                    list_n = None
+                else:
+                    list_n = 1 if n == 1 else list_n
+                    m_par = None
+        m_sec = None
+        if not (m_art or m_anx or m_part or m_par) and not state["article"]:
+            m_sec = _SECTION_RE.match(line)
+
+        if m_art or m_anx or m_part or m_par or m_sec:
+            unit = flush()
+            if unit:
+                yield unit
+            if m_art:
+                kind = "article"
+                state.update(article=m_art.group(1), paragraph=None, annex=None)
+                list_n = None
+            elif m_anx:
+                kind = "annex"
+                state.update(annex=m_anx.group(1), article=None, paragraph=None)
+                list_n = None
+            elif m_part:
+                kind = "part"
+                state.update(section=f"{m_part.group(1)} {m_part.group(2)}", article=None, paragraph=None, annex=None)
+            elif m_par:
+                kind = "paragraph"
+                state["paragraph"] = m_par.group(1)
+            else:
+                kind = "section"
+                state["section"] = m_sec.group(1) or m_sec.group(2)
+        buf.append(line)
+    unit = flush()
+    if unit:
+        yield unit
+
+def _bare_title(text: str) -> bool:
+    return len(text) <= HEADING_MAX_CHARS and not text.endswith((".", ";", ":"))
+
+def _heading_rank(u: dict) -> int:
+    """Nesting depth of a heading: TITLE/ANNEX 0, CHAPTER 1, Article 2, guidance section = its number depth."""
+    if u["kind"] == "article":
+        return 2
+    if u["kind"] == "section":
+        return u["section"].count(".") + 1
+    if u["kind"] == "part":
+        return 1 if u["section"].startswith("CHAPTER") else 0
+    return 0
+
+def attach_headings(units: Iterable[dict]) -> Iterator[dict]:
+    """
+    Heading-only units ride along with the next unit that has body text. A heading followed by one of the
+    same or a higher rank has no body: TOC entries and bare TITLE/Article/Annex titles (e.g. an empty
+    annex) are dropped, numbered sections (item lists such as the BPR data requirements) kept as text.
+    """
+    pending: List[dict] = []
+
+    def joined(u: dict) -> dict:
+        if not pending:
+            return u
+        head = pending[:]
+        pending.clear()
+        return {**u, "kind": head[0]["kind"], "heading": False, "text": " ".join([*(h["text"] for h in head), u["text"]])}
+
+    def bodyless(h: dict) -> Iterator[dict]:
+        if not h["toc"] and (h["kind"] == "section" or len(h["text"]) > HEADING_MAX_CHARS):
+            yield joined({**h, "heading": False})
+
+    for u in units:
+        if not u["heading"]:
+            yield joined(u)
+            continue
+        while pending and _heading_rank(pending[-1]) >= _heading_rank(u):
+            yield from bodyless(pending.pop())
+        pending.append(u)
+    while pending:
+        yield from bodyless(pending.pop())
+
+def _split_long(text: str, budget: int, first: Optional[int] = None) -> List[str]:
+    """
+    Split an oversized unit at sentence ends; hard-split only sentences longer than the budget. The first
+    piece may be held to a smaller size (the room left in the chunk it will join).
+    """
+    pieces: List[str] = []
+    cur = ""
+    limit = first or budget
+    for sent in _SENTENCE_RE.split(text):
+        while len(sent) > budget:
+            if cur:
+                pieces.append(cur)
+                cur = ""
+            cut = sent.rfind(" ", 0, budget)
+            cut = cut if cut > budget // 2 else budget
+            pieces.append(sent[:cut].strip())
+            sent = sent[cut:].strip()
+            limit = budget
+        if cur and len(cur) + 1 + len(sent) > limit:
+            pieces.append(cur)
+            cur = sent
+            limit = budget
+        else:
+            cur = f"{cur} {sent}" if cur else sent
+    if cur:
+        pieces.append(cur)
+    return pieces
+
+def _make_chunk(doc: str, units: List[dict]) -> dict:
+    # Location comes from the first Article/Annex unit (a leading TITLE/CHAPTER heading may be carried in)
+    lead = next((u for u in units if u["article"] or u["annex"]), units[0])
+    paras = [u["paragraph"] for u in units if u["paragraph"] and u["article"] == lead["article"] and u["annex"] == lead["annex"]]
+    paragraph = None
+    if paras:
+        paragraph = paras[0] if paras[0] == paras[-1] else f"{paras[0]}-{paras[-1]}"
+    label = ref_label(doc, lead["article"], paragraph, lead["annex"], lead["section"])
+    body = " ".join(u["text"] for u in units)
+    if units[0].get("continued") or units[0]["kind"] in ("paragraph", "body"):
+        body = f"[{label}] {body}"  # keep the legal reference in the embedded text
+    # Article/Annex units become spans rows; a unit split across chunks belongs to its first chunk, and a
+    # bare title (e.g. an annex point heading) is not worth an exact-reference hit of its own
+    spans = [
+        {"article": u["article"], "paragraph": u["paragraph"], "annex": u["annex"], "text": u.get("whole", u["text"])}
+        for u in units
+        if (u["article"] or u["annex"]) and not u.get("continued") and not _bare_title(u.get("whole", u["text"]))
+    ]
+    return {
+        "text": body,
+        "article": lead["article"],
+        "paragraph": paragraph,
+        "annex": lead["annex"],
+        "section": lead["section"],
+        "ref_label": label,
+        "spans": spans,
+    }
+
+def _pack_units(units: Iterable[dict], budget: int) -> Iterator[List[dict]]:
+    """Consecutive units of the same Article/Annex/section, up to budget chars per group."""
+    buf: List[dict] = []
+    size = 0
+
+    def key(u: dict):
+        return (u["article"], u["annex"], u["section"] if not (u["article"] or u["annex"]) else None)
+
+    for u in units:
+        pieces = [u["text"]]
+        if len(u["text"]) > budget:
+            room = budget - size - 1 if buf and key(u) == key(buf[0]) else budget
+            pieces = _split_long(u["text"], budget, first=room if room > budget // 4 else None)
+        for i, piece in enumerate(pieces):
+            part = u if len(pieces) == 1 else {**u, "text": piece, "whole": u["text"], "continued": i > 0}
+            n = len(piece)
+            if buf and (key(part) != key(buf[0]) or size + 1 + n > budget):
+                yield buf
+                buf, size = [], 0
+            buf.append(part)
+            size += n + (1 if size else 0)
+    if buf:
+        yield buf
+
+def _merge_small(groups: Iterable[List[dict]], budget: int, small: int) -> Iterator[List[dict]]:
+    """A group under `small` chars joins its neighbour (preceding first) while the pair fits the budget."""
+    held: Optional[List[dict]] = None
+    held_size = 0
+    for g in groups:
+        n = sum(len(u["text"]) for u in g) + len(g) - 1
+        if held is not None and min(held_size, n) < small and held_size + 1 + n <= budget:
+            held, held_size = held + g, held_size + 1 + n
+            continue
+        if held is not None:
+            yield held
+        held, held_size = g, n
+    if held is not None:
+        yield held
+
+def iter_structured_chunks(fragments: Iterable[str], budget_tokens: int, doc: str) -> Iterator[dict]:
+    """
+    Structure-aware chunker: never splits inside a paragraph unless the paragraph alone exceeds the
+    budget, packs consecutive units of the same Article/Annex/section up to budget_tokens, and records
+    article/paragraph/annex/section/ref_label for the payload. Headings travel with the text below them,
+    TOC entries are dropped and chunks under a quarter of the budget are merged into a neighbour.
+    """
+    budget = max(200, budget_tokens * CHARS_PER_TOKEN)
+    units = attach_headings(iter_units(iter_lines(fragments)))
+    for group in _merge_small(_pack_units(units, budget), budget, budget // 4):
+        yield _make_chunk(doc, group)
+
+def iter_file_chunks(fragments: Iterable[str], path: str) -> Iterator[dict]:
+    """Chunks for one file as dicts with at least "text", using CHUNK_STRATEGY."""
+    if CHUNK_STRATEGY == "fixed":
+        for c in iter_chunks(fragments, CHUNK_SIZE, CHUNK_OVERLAP):
+            yield {"text": c}
+        return
+    yield from iter_structured_chunks(fragments, CHUNK_TOKENS, doc_label(path))
+
+def estimate_chunks(path: str, size: int, overlap: int, n_pages: Optional[int] = None) -> int:
+    """Cheap chunk-count guess (page count or file size) used for the progress total before chunking."""
+    step = max(1, size - overlap) if CHUNK_STRATEGY == "fixed" else max(1, CHUNK_TOKENS * CHARS_PER_TOKEN)
+    try:
+        if path.lower().endswith(".pdf"):
+            chars = (n_pages if n_pages is not None else count_pdf_pages(path)) * EST_CHARS_PER_PDF_PAGE
+        else:
+            chars = os.path.getsize(path)
+    except Exception:
+        return 1
+    return max(1, chars // step)
+
+def extract_pdf_pages(path: str, start: int, end: int) -> Tuple[List[str], float]:
+    """Process-pool task: extract pages [start, end) of one PDF. Returns (page texts, seconds spent)."""
+    from pypdf import PdfReader
+
+    t0 = time.time()
+    reader = PdfReader(path)
+    texts = []
+    for i in range(start, end):
+        try:
+            t = reader.pages[i].extract_text() or ""
+        except Exception:
+            t = ""  # skip unreadable page but keep going
+        texts.append(t)
+    return texts, time.time() - t0
+
+class PageCache:
+    """
+    Extracted PDF page text keyed by (file_sha1, page), zlib-compressed in one SQLite file, so a re-run
+    (e.g. after changing CHUNK_SIZE) skips PDF parsing entirely. Only the main process touches it.
+    """
+
+    def __init__(self, path: str):
+        self.db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        if not path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                " file_sha1 TEXT NOT NULL, page INTEGER NOT NULL, text BLOB NOT NULL,"
+                " PRIMARY KEY (file_sha1, page)) WITHOUT ROWID"
+            )
+            self.db.commit()
+        except sqlite3.Error as e:
+            print(f"[WARN] page cache disabled ({path}): {e}", flush=True)
+            self.db = None
+
+    def cached_pages(self, sha1: str) -> Set[int]:
+        if self.db is None:
+            return set()
+        return {r[0] for r in self.db.execute("SELECT page FROM pages WHERE file_sha1 = ?", (sha1,))}
+
+    def get(self, sha1: str, start: int, end: int) -> List[str]:
+        rows = dict(self.db.execute(
+            "SELECT page, text FROM pages WHERE file_sha1 = ? AND page >= ? AND page < ?", (sha1, start, end)
+        ))
+        self.hits += end - start
+        return [zlib.decompress(rows[i]).decode("utf-8") if i in rows else "" for i in range(start, end)]
+
+    def put(self, sha1: str, start: int, texts: List[str]):
+        self.misses += len(texts)
+        if self.db is None:
+            return
+        self.db.executemany(
+            "INSERT OR REPLACE INTO pages (file_sha1, page, text) VALUES (?, ?, ?)",
+            [(sha1, start + i, zlib.compress(t.encode("utf-8"))) for i, t in enumerate(texts)],
+        )
+        self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
 def file_sha1(path: str) -> str:
     h = hashlib.sha1()
     with open(path, "rb") as f:
@@ -107,17 +619,109 @@ def file_sha1(path: str) -> str:
             h.update(block)
     return h.hexdigest()
 
-def ensure_collection(client: QdrantClient, collection: str, vector_size: int = 768, distance="Cosine"):
+def ensure_collection(client: QdrantClient, collection: str, vector_size: int = 768, distance="Cosine",
+                      sparse: bool = False) -> bool:
+    """Create the collection if missing; returns whether it carries the sparse (lexical) vector."""
     # Try to get; if missing, create (avoid deprecated recreate_collection)
     try:
-        client.get_collection(collection_name=collection)
-        return
+        info = client.get_collection(collection_name=collection)
     except Exception:
-        pass
+        info = None
+    if info is not None:
+        have = SPARSE_VECTOR_NAME in (info.config.params.sparse_vectors or {})
+        if sparse and not have:
+            # Qdrant cannot add a sparse vector to an existing collection
+            print(f"[WARN] collection {collection} has no '{SPARSE_VECTOR_NAME}' sparse vector; hybrid retrieval "
+                  f"needs a fresh collection (drop it or set QDRANT_COLLECTION to a new name).", flush=True)
+        return have
     client.create_collection(
         collection_name=collection,
         vectors_config=qmodels.VectorParams(size=vector_size, distance=distance),
+        sparse_vectors_config=(
+            {SPARSE_VECTOR_NAME: qmodels.SparseVectorParams(modifier=qmodels.Modifier.IDF)} if sparse else None
+        ),
     )
+    return sparse
+
+PAYLOAD_INDEXES = (
+    ("file_sha1", qmodels.PayloadSchemaType.KEYWORD),
+    ("chunk_sha1", qmodels.PayloadSchemaType.KEYWORD),
+    ("source_name", qmodels.PayloadSchemaType.KEYWORD),
+    ("chunk_index", qmodels.PayloadSchemaType.INTEGER),
+)
+
+def ensure_payload_indexes(client: QdrantClient, collection: str, fields=PAYLOAD_INDEXES):
+    # Indexes keep resume / dedup / stale-version filters cheap; creating an existing index is a no-op
+    for field, schema in fields:
+        try:
+            client.create_payload_index(collection_name=collection, field_name=field, field_schema=schema)
+        except Exception as e:
+            print(f"[WARN] payload index on {field} not created: {e}", flush=True)
+
+CELEX_DOC_TYPES = {"R": "regulation", "L": "directive", "D": "decision"}
+
+class SpanStore:
+    """
+    Postgres documents/spans rows for CELEX acts, written from the same chunking run as the vectors so the
+    API can answer "REACH Art. 57(1)" with an indexed lookup. One document row per CELEX number.
+    """
+
+    SCHEMA = (
+        # Columns added after the original init script; the API joins spans back to Qdrant chunks with them
+        "ALTER TABLE documents ADD COLUMN IF NOT EXISTS source_name TEXT",
+        "ALTER TABLE spans ADD COLUMN IF NOT EXISTS chunk_index INT",
+        "ALTER TABLE documents ADD COLUMN IF NOT EXISTS spans_sha1 TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_documents_celex ON documents(celex)",
+    )
+
+    def __init__(self, url: str):
+        try:
+            import psycopg
+        except ImportError as e:
+            raise RuntimeError("psycopg is required for spans ingestion. Install with: pip install psycopg[binary]") from e
+        self.conn = psycopg.connect(url, autocommit=True)
+        for stmt in self.SCHEMA:
+            self.conn.execute(stmt)
+        self.written = 0
+
+    @staticmethod
+    def digest(spans: List[Tuple[int, dict]]) -> str:
+        """Fingerprint of the spans and the chunks they point at; changes with CHUNK_TOKENS, strategy or chunker."""
+        h = hashlib.sha1()
+        for idx, sp in spans:
+            h.update(f"{idx}\x1f{sp['article']}\x1f{sp['annex']}\x1f{sp['paragraph']}\x1f{sp['text']}\x1e".encode("utf-8"))
+        return h.hexdigest()
+
+    def current(self, celex: str, sha1: str, digest: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM documents WHERE celex = %s AND hash = %s AND spans_sha1 = %s LIMIT 1", (celex, sha1, digest)
+        ).fetchone()
+        return row is not None
+
+    def replace(self, celex: str, path: str, sha1: str, spans: List[Tuple[int, dict]], digest: str) -> None:
+        """Swap in this file version's spans (older versions of the act are dropped, spans cascade)."""
+        doc = CELEX_LABELS.get(celex, celex)
+        with self.conn.transaction():
+            self.conn.execute("DELETE FROM documents WHERE celex = %s", (celex,))
+            doc_id = self.conn.execute(
+                """INSERT INTO documents (celex, title, doc_type, lang, hash, source_name, spans_sha1)
+                   VALUES (%s, %s, %s, 'en', %s, %s, %s) RETURNING doc_id""",
+                (celex, doc, CELEX_DOC_TYPES.get(celex[5]), sha1, os.path.basename(path), digest),
+            ).fetchone()[0]
+            with self.conn.cursor() as cur:
+                cur.executemany(
+                    """INSERT INTO spans (doc_id, ref_label, article, annex, paragraph, text, chunk_index)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                    [
+                        (doc_id, ref_label(doc, sp["article"], sp["paragraph"], sp["annex"], None),
+                         sp["article"], sp["annex"], sp["paragraph"], sp["text"], idx)
+                        for idx, sp in spans
+                    ],
+                )
+        self.written += len(spans)
+
+    def close(self) -> None:
+        self.conn.close()
 
 def guess_vector_size_for_model(name: str) -> int:
     table = {
@@ -158,7 +762,7 @@ def format_duration(seconds: float) -> str:
     return f"{s}s"
 
 def embed_text_once(t: str, model: str, base_url: str, timeout: int = 120) -> List[float]:
-    r = requests.post(f"{base_url}/api/embeddings", json={"model": model, "prompt": t}, timeout=timeout)
+    r = http_session.post(f"{base_url}/api/embeddings", json={"model": model, "prompt": t}, timeout=timeout)
     r.raise_for_status()
     return r.json()["embedding"]
 
@@ -177,155 +781,641 @@ def embed_text(t: str, model: str, base_url: str, timeout: int = 120) -> List[fl
     # if we reach here, all retries failed
     raise RuntimeError(f"Embedding failed after {EMBED_MAX_RETRIES} attempts: {last_err}")
 
+def embed_texts_once(texts: List[str], model: str, base_url: str, timeout: int = 600) -> List[List[float]]:
+    r = http_session.post(f"{base_url}/api/embed", json={"model": model, "input": texts}, timeout=timeout)
+    r.raise_for_status()
+    vecs = r.json()["embeddings"]
+    if len(vecs) != len(texts):
+        raise ValueError(f"/api/embed returned {len(vecs)} embeddings for {len(texts)} inputs")
+    return vecs
+
+class BatchEmbedder:
+    """
+    Embeds many chunks per /api/embed call. The batch size doubles while batches finish well under
+    EMBED_BATCH_TARGET_SECONDS and halves when they run over or fail. A batch that still fails after
+    retries is embedded one chunk at a time; an Ollama without /api/embed switches to single mode for good.
+    """
+
+    def __init__(self, model: str, base_url: str, batch_size: int = EMBED_BATCH_SIZE,
+                 max_batch: int = EMBED_BATCH_MAX, target_seconds: float = EMBED_BATCH_TARGET_SECONDS):
+        self.model = model
+        self.base_url = base_url
+        self.max_batch = max(1, max_batch)
+        self.batch_size = min(max(1, batch_size), self.max_batch)
+        self.target_seconds = target_seconds
+        self.single = self.batch_size <= 1
+
+    def _adapt(self, elapsed: float, n: int):
+        if elapsed > self.target_seconds and self.batch_size > 1:
+            self.batch_size = max(1, self.batch_size // 2)
+        elif elapsed < self.target_seconds / 2 and n >= self.batch_size:
+            self.batch_size = min(self.max_batch, self.batch_size * 2)
+
+    def _embed_singly(self, texts: List[str]) -> List[List[float]]:
+        return [embed_text(t, self.model, self.base_url) for t in texts]
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        if self.single or len(texts) == 1:
+            return self._embed_singly(texts)
+
+        delay = 0.0
+        last_err: Optional[Exception] = None
+        for attempt in range(1, EMBED_MAX_RETRIES + 1):
+            try:
+                if delay > 0:
+                    time.sleep(delay)
+                t0 = time.time()
+                vecs = embed_texts_once(texts, self.model, self.base_url, EMBED_BATCH_TIMEOUT)
+                self._adapt(time.time() - t0, len(texts))
+                return vecs
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code in (404, 405):
+                    print(f"[WARN] {self.base_url}/api/embed unavailable; using /api/embeddings per chunk.", flush=True)
+                    self.single = True
+                    return self._embed_singly(texts)
+                last_err = e
+            except Exception as e:
+                last_err = e
+            delay = delay * EMBED_RETRY_BACKOFF + 0.25 if delay > 0 else 0.5
+
+        self.batch_size = max(1, self.batch_size // 2)
+        print(f"[WARN] batch of {len(texts)} failed after {EMBED_MAX_RETRIES} attempts ({last_err}); "
+              f"falling back to single-chunk calls (next batch size {self.batch_size}).", flush=True)
+        return self._embed_singly(texts)
+
 # --- NEW: resume support -------------------------------------------------------
 
-def existing_chunk_indexes(client: QdrantClient, collection: str, file_sha1: str) -> Set[int]:
+def chunk_sha1(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class ResumeIndex:
     """
-    Return the set of chunk_index values already present in Qdrant for a given file_sha1.
-    Uses scroll with a filter; IMPORTANT: use 'scroll_filter' kwarg for this client.
+    What the collection already holds, loaded with ONE scroll per run that projects only
+    file_sha1 / chunk_index / chunk_sha1 (no text, no vectors):
+      by_file: {file_sha1: {chunk_index: chunk_sha1 or None for legacy points}}
+      hashes:  every chunk_sha1 present, so dedup lookups only hit Qdrant when a match exists
     """
-    found: Set[int] = set()
-    offset = None
+
+    FIELDS = ["file_sha1", "chunk_index", "chunk_sha1"]
+
+    def __init__(self):
+        self.by_file: Dict[str, Dict[int, Optional[str]]] = {}
+        self.hashes: Set[str] = set()
+        self.points = 0
+
+    @classmethod
+    def build(cls, client: QdrantClient, collection: str, page: int = 10000) -> "ResumeIndex":
+        idx = cls()
+        offset = None
+        while True:
+            points, offset = client.scroll(
+                collection_name=collection,
+                limit=page,
+                with_payload=cls.FIELDS,  # payload selector: only these keys come back
+                with_vectors=False,
+                offset=offset,
+            )
+            for p in points:
+                pl = p.payload or {}
+                ci = pl.get("chunk_index")
+                sha1 = pl.get("file_sha1")
+                if isinstance(ci, int) and sha1:
+                    idx.by_file.setdefault(sha1, {})[ci] = pl.get("chunk_sha1")
+                if pl.get("chunk_sha1"):
+                    idx.hashes.add(pl["chunk_sha1"])
+                idx.points += 1
+            if not offset:
+                break
+        return idx
+
+    def chunks_for(self, file_sha1: str) -> Dict[int, Optional[str]]:
+        return self.by_file.get(file_sha1, {})
+
+def vectors_by_chunk_hash(client: QdrantClient, collection: str, hashes: List[str]) -> Dict[str, List[float]]:
+    """Look up already-embedded vectors for identical chunk text anywhere in the collection."""
+    found: Dict[str, List[float]] = {}
+    if not hashes:
+        return found
     flt = qmodels.Filter(
-        must=[qmodels.FieldCondition(key="file_sha1", match=qmodels.MatchValue(value=file_sha1))]
+        must=[qmodels.FieldCondition(key="chunk_sha1", match=qmodels.MatchAny(any=list(hashes)))]
     )
+    offset = None
     while True:
         points, offset = client.scroll(
             collection_name=collection,
-            limit=1000,
-            with_payload=True,
-            with_vectors=False,
-            scroll_filter=flt,  # <- not "filter"
+            limit=max(64, len(hashes)),
+            with_payload=["chunk_sha1"],
+            with_vectors=True,
+            scroll_filter=flt,
             offset=offset,
         )
         for p in points:
-            ci = (p.payload or {}).get("chunk_index")
-            if isinstance(ci, int):
-                found.add(ci)
-        if not offset:
+            h = (p.payload or {}).get("chunk_sha1")
+            vec = p.vector.get("") if isinstance(p.vector, dict) else p.vector  # dense part only
+            if h and vec is not None:
+                found.setdefault(h, vec)
+        if not offset or len(found) == len(hashes):
             break
     return found
 
-# ------------------------------------------------------------------------------
+def delete_stale_points(client: QdrantClient, collection: str, path: str, file_sha1: str, n_chunks: int,
+                        by_path: bool = False) -> int:
+    """
+    Bulk-delete points superseded by this run for one file: other versions of the same document, and
+    chunk indexes past the end of the current version (e.g. after a chunking change). Documents are
+    identified by source_name, or by source_path when several scanned files share a basename.
+    """
+    if by_path:
+        name_match = qmodels.FieldCondition(key="source_path", match=qmodels.MatchValue(value=os.path.abspath(path)))
+    else:
+        name_match = qmodels.FieldCondition(key="source_name", match=qmodels.MatchValue(value=os.path.basename(path)))
+    sha_match = qmodels.FieldCondition(key="file_sha1", match=qmodels.MatchValue(value=file_sha1))
+    filters = [
+        qmodels.Filter(must=[name_match], must_not=[sha_match]),
+        qmodels.Filter(must=[sha_match, qmodels.FieldCondition(key="chunk_index", range=qmodels.Range(gte=n_chunks))]),
+    ]
+    removed = 0
+    for flt in filters:
+        n = client.count(collection_name=collection, count_filter=flt, exact=True).count
+        if n:
+            client.delete(collection_name=collection, points_selector=qmodels.FilterSelector(filter=flt))
+            removed += n
+    return removed
 
-def main():
-    vec_size = guess_vector_size_for_model(EMBED_MODEL)
-    client = QdrantClient(url=QDRANT_URL, prefer_grpc=False)
-    ensure_collection(client, COLLECTION, vector_size=vec_size, distance="Cosine")
+# --- Pipelined ingestion --------------------------------------------------------
 
-    files = scan_files(DATA_DIR)
-    if not files:
-        print(f"No files found in {DATA_DIR}. Add PDFs or TXTs and re-run.", flush=True)
-        return
+class StageStats:
+    """Thread-safe throughput/utilisation counters for one pipeline stage."""
 
-    print(f"Found {len(files)} files under {DATA_DIR}. Embedding with {EMBED_MODEL} via {OLLAMA_URL}", flush=True)
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = max(1, workers)
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
 
-    # -------- First pass: read & chunk so we know total work --------
-    file_chunks = []  # list[(path, [chunks])]
-    total_chunks = 0
-    read_start = time.time()
+    def add(self, items: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.busy += seconds
 
-    for path in files:
-        print(f"[READ] {path}", flush=True)
-        try:
-            text = read_text_from_file(path)
-        except Exception as e:
-            print(f"[SKIP] {path}: {e}", flush=True)
-            continue
+    def summary(self, wall: float) -> str:
+        rate = self.items / wall if wall > 0 else 0.0
+        util = self.busy / (wall * self.workers) if wall > 0 else 0.0
+        return f"{self.name:<8} {self.items:>7} chunks | {rate:7.1f} ch/s | busy {util:4.0%} of {self.workers} worker(s)"
 
-        chunks = chunk_text(text, CHUNK_SIZE, CHUNK_OVERLAP)
-        if not chunks:
-            print(f"[SKIP] {path}: no text extracted", flush=True)
-            continue
+def iter_page_events(pool: ProcessPoolExecutor, files: List[str], page_counts: Dict[str, Optional[int]],
+                     cache: PageCache, window: int) -> Iterator[tuple]:
+    """
+    Flattened, in-order event stream over all files:
+      ("begin", path, sha1) · ("text", fragment)* · ("end", path, extract_seconds)   or   ("error", path, exc)
+    PDF page blocks missing from the cache are submitted to the process pool up to `window` blocks ahead
+    (across file boundaries), so extraction stays busy while memory stays bounded.
+    """
+    def plan():
+        for path in files:
+            if not path.lower().endswith(".pdf"):
+                yield ("txt", path)
+                continue
+            n_pages = page_counts.get(path)
+            if n_pages is None:
+                try:
+                    n_pages = count_pdf_pages(path)
+                except Exception as e:
+                    yield ("error", path, e)
+                    continue
+            sha1 = file_sha1(path)
+            have = cache.cached_pages(sha1)
+            yield ("begin", path, sha1)
+            block = max(1, PDF_PAGE_BLOCK)
+            for start in range(0, n_pages, block):
+                end = min(start + block, n_pages)
+                cached = all(i in have for i in range(start, end))
+                yield ("pages", path, sha1, start, end, cached)
+            yield ("end", path)
 
-        file_chunks.append((path, chunks))
-        total_chunks += len(chunks)
+    tasks = plan()
+    ahead: deque = deque()
+    in_flight = 0
 
-    read_elapsed = time.time() - read_start
+    def pull() -> bool:
+        nonlocal in_flight
+        task = next(tasks, None)
+        if task is None:
+            return False
+        if task[0] == "pages" and not task[5]:
+            task = task + (pool.submit(extract_pdf_pages, task[1], task[3], task[4]),)
+            in_flight += 1
+        ahead.append(task)
+        return True
 
-    if total_chunks == 0:
-        print("No chunks to embed. Exiting.", flush=True)
-        return
+    seconds: Dict[str, float] = {}
+    while True:
+        while in_flight < window and len(ahead) < 4 * window and pull():
+            pass
+        if not ahead and not pull():
+            return
+        task = ahead.popleft()
+        kind = task[0]
+        if kind == "txt":
+            path = task[1]
+            yield ("begin", path, file_sha1(path))
+            t0 = time.time()
+            try:
+                for frag in iter_text_fragments(path, progress=False):
+                    yield ("text", frag)
+            except Exception as e:
+                print(f"[WARN] {path}: {e}", flush=True)
+            yield ("end", path, time.time() - t0)
+        elif kind == "pages":
+            _, path, sha1, start, end, cached = task[:6]
+            if cached:
+                texts = cache.get(sha1, start, end)
+            else:
+                in_flight -= 1
+                try:
+                    texts, took = task[6].result()
+                    seconds[path] = seconds.get(path, 0.0) + took
+                    cache.put(sha1, start, texts)
+                except Exception as e:
+                    print(f"[WARN] {os.path.basename(path)}: pages {start}-{end - 1} unreadable: {e}", flush=True)
+                    texts = [""] * (end - start)
+            for i, t in enumerate(texts, start=start):
+                if i:
+                    yield ("text", "\n")
+                yield ("text", t)
+        elif kind == "end":
+            yield ("end", task[1], seconds.pop(task[1], 0.0))
+        else:
+            yield task
 
-    print(f"Prepared {total_chunks} chunks from {len(file_chunks)} files in {format_duration(read_elapsed)}.", flush=True)
+# ---------- Sparse (lexical) vectors ----------
+# Keep the tokenizer in sync with apps/api/main.py: queries and chunks must map terms to the same indices.
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or shall that the this to was were which with".split()
+)
+# Compound terms first: CAS / EC numbers (50-00-0, 200-001-8), act numbers (1907/2006), references like 57(f) or 5(1)(a)
+_LEX_TOKEN_RE = re.compile(r"\d{2,7}-\d{2,3}-\d|\d+/\d+|\d+[a-z]?(?:\([0-9a-z]{1,4}\))+|[^\W_]+")
+_LEX_PART_RE = re.compile(r"[^\W_]+")
 
-    # -------- Second pass: embed + upsert with global progress/ETA --------
-    global_start = time.time()
-    processed = 0
-    total_points = 0
-    pbar = tqdm(total=total_chunks, desc=f"Embedding all chunks ({EMBED_MODEL})", unit="chunk")
+def lexical_terms(text: str) -> List[str]:
+    """Lowercased terms plus the parts of compound legal references, so "57(f)" also matches "Article 57"."""
+    terms: List[str] = []
+    for m in _LEX_TOKEN_RE.finditer(unicodedata.normalize("NFKC", text).lower()):
+        tok = m.group(0)
+        if tok in _STOPWORDS or (len(tok) == 1 and not tok.isdigit()):
+            continue
+        terms.append(tok)
+        if "(" in tok or "/" in tok:  # CAS / EC numbers stay whole
+            terms.extend(p for p in _LEX_PART_RE.findall(tok) if len(p) > 1 or p.isdigit())
+    return terms
+
+def term_index(term: str) -> int:
+    return zlib.crc32(term.encode("utf-8"))
+
+def sparse_vector(text: str) -> qmodels.SparseVector:
+    """BM25 term-frequency part per term; the IDF part is applied by Qdrant (Modifier.IDF)."""
+    terms = lexical_terms(text)
+    tf: Dict[int, int] = {}
+    for t in terms:
+        i = term_index(t)
+        tf[i] = tf.get(i, 0) + 1
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * len(terms) / BM25_AVG_TOKENS)
+    return qmodels.SparseVector(
+        indices=list(tf), values=[n * (BM25_K1 + 1) / (n + norm) for n in tf.values()]
+    )
 
-    for path, chunks in file_chunks:
-        file_start = time.time()
-        sha1 = file_sha1(path)
+CHUNK_META_FIELDS = ("article", "paragraph", "annex", "section", "ref_label")
 
-        # Resume: figure out which chunk indexes already exist
-        already: Set[int] = set()
-        if RESUME:
+def build_points(path: str, sha1: str, items: List[Tuple[int, dict, str]], vectors: List[List[float]],
+                 sparse: bool = False) -> List[qmodels.PointStruct]:
+    now = int(time.time())
+    points: List[qmodels.PointStruct] = []
+    for (idx, chunk, h), vec in zip(items, vectors):
+        pid = int(hashlib.md5(f"{sha1}:{idx}".encode()).hexdigest()[:16], 16) % (2**63 - 1)
+        payload = {
+            "source_path": os.path.abspath(path),
+            "source_name": os.path.basename(path),
+            "file_sha1": sha1,
+            "chunk_index": idx,
+            "chunk_sha1": h,
+            "created_at": now,
+            "text": chunk["text"],  # enable excerpts in API responses
+        }
+        payload.update({k: chunk[k] for k in CHUNK_META_FIELDS if chunk.get(k)})
+        if sparse:
+            # Unnamed dense vector lives under "" next to the named sparse one
+            vec = {"": vec, SPARSE_VECTOR_NAME: sparse_vector(chunk["text"])}
+        points.append(qmodels.PointStruct(id=pid, vector=vec, payload=payload))
+    return points
+
+def embed_worker(embedder: "BatchEmbedder", jobs: "queue.Queue", results: "queue.Queue",
+                 stats: StageStats, errors: List[Exception], on_embedded):
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        vectors = None
+        if not errors:  # after the first failure, drain without doing more work
+            t0 = time.time()
             try:
-                already = existing_chunk_indexes(client, COLLECTION, sha1)
+                vectors = embedder.embed_batch([c["text"] for _, c, _ in job["items"]])
             except Exception as e:
-                print(f"[WARN] resume lookup failed for {os.path.basename(path)}: {e}", flush=True)
+                errors.append(e)
+            stats.add(len(job["items"]), time.time() - t0)
+        if vectors is not None:
+            on_embedded(len(job["items"]))
+        results.put((job, vectors))
 
-        # Select only missing chunks
-        to_embed = [(i, c) for i, c in enumerate(chunks) if i not in already] if RESUME else list(enumerate(chunks))
+def upsert_writer(client: QdrantClient, results: "queue.Queue", stats: StageStats, errors: List[Exception],
+                  on_written, sparse: bool = False):
+    while True:
+        item = results.get()
+        if item is None:
+            break
+        job, vectors = item
+        written = 0
+        if vectors is not None:
+            t0 = time.time()
+            try:
+                points = build_points(job["file"]["path"], job["file"]["sha1"], job["items"], vectors, sparse=sparse)
+                upsert_batches(client, COLLECTION, points, BATCH_SIZE)
+                written = len(points)
+            except Exception as e:
+                # Keep draining: a dead writer would block the embedders on a full results queue
+                print(f"[ERR] upsert failed for {os.path.basename(job['file']['path'])}: {e}", flush=True)
+                errors.append(e)
+            stats.add(written, time.time() - t0)
+        on_written(job, written)
 
-        if RESUME:
-            print(f"[RESUME] {os.path.basename(path)}: have {len(already)}/{len(chunks)}; embedding {len(to_embed)} missing.", flush=True)
+# ------------------------------------------------------------------------------
 
-        if not to_embed:
-            # nothing to do for this file
-            continue
+def main():
+    vec_size = guess_vector_size_for_model(EMBED_MODEL)
+    client = QdrantClient(url=QDRANT_URL, prefer_grpc=False, limits=qdrant_http_limits())
+    sparse = ensure_collection(client, COLLECTION, vector_size=vec_size, distance="Cosine", sparse=SPARSE_INDEX)
+    ensure_payload_indexes(client, COLLECTION)
+
+    files = scan_files(DATA_DIR)
+    if not files:
+        print(f"No files found in {DATA_DIR}. Add PDFs or TXTs and re-run.", flush=True)
+        return
 
-        # Embed (only missing)
-        vectors: List[List[float]] = []
-        for _, chunk in to_embed:
-            vec = embed_text(chunk, EMBED_MODEL, OLLAMA_URL)
-            vectors.append(vec)
-            processed += 1
-            pbar.update(1)
+    print(f"Found {len(files)} files under {DATA_DIR}. Embedding with {EMBED_MODEL} via {OLLAMA_URL}", flush=True)
+    names = [os.path.basename(p) for p in files]
+    shared_names = {n for n in names if names.count(n) > 1}
+    print(f"Chunking: {CHUNK_STRATEGY}"
+          + (f" (budget {CHUNK_TOKENS} tokens)" if CHUNK_STRATEGY != "fixed" else f" ({CHUNK_SIZE} chars, overlap {CHUNK_OVERLAP})"),
+          flush=True)
+    print(f"Sparse index: {SPARSE_VECTOR_NAME if sparse else 'off'}", flush=True)
+    print(f"Pipeline: {EXTRACT_WORKERS} extract process(es), {EMBED_CONCURRENCY} embed worker(s), "
+          f"1 writer, queue depth {PIPELINE_QUEUE_DEPTH}", flush=True)
+
+    # -------- Resume index: one projected scroll instead of a filtered scan per file --------
+    resume_index = ResumeIndex()
+    if RESUME:
+        t0 = time.time()
+        try:
+            resume_index = ResumeIndex.build(client, COLLECTION)
+            print(f"Resume index: {resume_index.points} points, {len(resume_index.by_file)} file versions "
+                  f"in {time.time() - t0:.1f}s", flush=True)
+        except Exception as e:
+            print(f"[WARN] resume index build failed ({e}); embedding everything.", flush=True)
+
+    # -------- Cheap total estimate (page counts / file sizes); refined as files are chunked --------
+    page_counts: Dict[str, Optional[int]] = {}
+    for path in files:
+        if path.lower().endswith(".pdf"):
+            try:
+                page_counts[path] = count_pdf_pages(path)
+            except Exception:
+                page_counts[path] = None  # reported as [SKIP] when the file comes up
+    estimates = {path: estimate_chunks(path, CHUNK_SIZE, CHUNK_OVERLAP, page_counts.get(path)) for path in files}
+    total_est = sum(estimates.values())
+    print(f"Estimated ~{total_est} chunks (refined while streaming).", flush=True)
+
+    # -------- Streaming: extract (process pool) -> chunk -> embed (worker pool) -> upsert (writer) --------
+    global_start = time.time()
+    pbar = tqdm(total=total_est, desc=f"Embedding all chunks ({EMBED_MODEL})", unit="chunk")
+    embedder = BatchEmbedder(EMBED_MODEL, OLLAMA_URL)
+    extract_stats = StageStats("extract", EXTRACT_WORKERS)
+    embed_stats = StageStats("embed", EMBED_CONCURRENCY)
+    upsert_stats = StageStats("upsert", 1)
+    progress = {"processed": 0, "points": 0, "total": total_est}
+    report = {"added": 0, "reused": 0, "unchanged": 0, "removed": 0}
+    progress_lock = threading.Lock()
+    errors: List[Exception] = []
+    # Points without chunk_sha1 predate hashing and were cut by fixed-size chunking: only then is index == same text
+    legacy_ok = CHUNK_STRATEGY == "fixed"
+    span_store: Optional[SpanStore] = None
+    if SPANS_INGEST and DATABASE_URL and CHUNK_STRATEGY != "fixed":
+        try:
+            span_store = SpanStore(DATABASE_URL)
+        except Exception as e:
+            print(f"[WARN] spans ingestion disabled: {e}", flush=True)
+
+    def on_embedded(n: int):
+        with progress_lock:
+            progress["processed"] += n
+            processed = progress["processed"]
+            pbar.update(n)
 
             # ETA estimate (global)
             elapsed = time.time() - global_start
-            if processed % 25 == 0 or processed == total_chunks:
+            if processed % 25 < n or processed == progress["total"]:
                 rate = processed / elapsed if elapsed > 0 else 0.0
-                remaining = total_chunks - processed
+                remaining = max(0, progress["total"] - processed)
                 eta = remaining / rate if rate > 0 else 0
                 pbar.set_description(
                     f"Embedding all chunks ({EMBED_MODEL}) | {rate:.1f} ch/s | ETA {format_duration(eta)}"
                 )
 
-        file_elapsed = time.time() - file_start
-
-        # Build points & upsert (only for missing indexes)
-        now = int(time.time())
-        points: List[qmodels.PointStruct] = []
-        for (idx, chunk), vec in zip(to_embed, vectors):
-            pid = int(hashlib.md5(f"{sha1}:{idx}".encode()).hexdigest()[:16], 16) % (2**63 - 1)
-            payload = {
-                "source_path": os.path.abspath(path),
-                "source_name": os.path.basename(path),
-                "file_sha1": sha1,
-                "chunk_index": idx,
-                "created_at": now,
-                "text": chunk[:1200],  # enable excerpts in API responses
-            }
-            points.append(qmodels.PointStruct(id=pid, vector=vec, payload=payload))
-
-        if points:
-            upsert_batches(client, COLLECTION, points, BATCH_SIZE)
-            total_points += len(points)
-
-        have_now = len(already) + len(points) if RESUME else len(points)
-        rate_file = (len(to_embed) / file_elapsed) if file_elapsed > 0 else 0.0
+    def set_total(total: int):
+        with progress_lock:
+            progress["total"] = total
+            pbar.total = total
+            pbar.refresh()
+
+    def maybe_finish(f: dict):
+        # Called by the producer (file closed) and the writer (batch written); whoever completes it reports
+        with progress_lock:
+            if f["reported"] or not f["closed"] or f["written"] < f["queued"]:
+                return
+            f["reported"] = True
+            failed = f["failed"] or bool(errors)
+        if failed:
+            # Some new points are missing: keep the superseded ones so the file stays searchable
+            why = f"{f['failed']}/{f['queued']} chunks not written" if f["failed"] else "run failed"
+            print(f"[FAIL] {os.path.basename(f['path'])}: {why}; stale points kept.", flush=True)
+            return
+        # All new points are in: now drop what this version superseded
+        removed = 0
+        try:
+            removed = delete_stale_points(client, COLLECTION, f["path"], f["sha1"], f["n_chunks"],
+                                          by_path=os.path.basename(f["path"]) in shared_names)
+        except Exception as e:
+            print(f"[WARN] stale point cleanup failed for {os.path.basename(f['path'])}: {e}", flush=True)
+        with progress_lock:
+            report["removed"] += removed
+        # Spans point at chunk numbers, so they follow the points, never ahead of them
+        celex = doc_celex(f["path"])
+        if span_store and celex and f["spans"]:
+            try:
+                digest = SpanStore.digest(f["spans"])
+                if not span_store.current(celex, f["sha1"], digest):
+                    span_store.replace(celex, f["path"], f["sha1"], f["spans"], digest)
+                    print(f"[SPANS] {os.path.basename(f['path'])}: {len(f['spans'])} spans for {celex}", flush=True)
+            except Exception as e:
+                print(f"[WARN] spans for {os.path.basename(f['path'])} not written: {e}", flush=True)
+        file_elapsed = time.time() - f["start"]
+        rate_file = (f["queued"] / file_elapsed) if file_elapsed > 0 else 0.0
         print(
-            f"[OK] {os.path.basename(path)}: upserted {len(points)} missing chunks "
-            f"(now have ~{have_now}/{len(chunks)}). Took {format_duration(file_elapsed)} ({rate_file:.1f} ch/s)",
+            f"[OK] {os.path.basename(f['path'])}: {f['n_chunks']} chunks; added {f['added']}, reused {f['reused']}, "
+            f"unchanged {f['unchanged']}, removed {removed}. Took {format_duration(file_elapsed)} ({rate_file:.1f} ch/s)",
             flush=True
         )
 
-    pbar.close()
+    def on_written(job: dict, written: int):
+        f = job["file"]
+        with progress_lock:
+            f["written"] += len(job["items"])
+            f["failed"] += len(job["items"]) - written  # embed or upsert error
+            f["upserted"] += written
+            progress["points"] += written
+        maybe_finish(f)
+
+    jobs: "queue.Queue" = queue.Queue(maxsize=max(1, PIPELINE_QUEUE_DEPTH))
+    results: "queue.Queue" = queue.Queue(maxsize=max(1, PIPELINE_QUEUE_DEPTH))
+    workers = [
+        threading.Thread(target=embed_worker, args=(embedder, jobs, results, embed_stats, errors, on_embedded),
+                         name=f"embed-{i}", daemon=True)
+        for i in range(max(1, EMBED_CONCURRENCY))
+    ]
+    writer = threading.Thread(target=upsert_writer, args=(client, results, upsert_stats, errors, on_written, sparse),
+                              name="upsert", daemon=True)
+    for t in workers:
+        t.start()
+    writer.start()
+
+    files_done = 0
+    chunks_seen = 0
+    est_done = 0
+    est_left = total_est
+    page_cache = PageCache(PAGE_CACHE_PATH)
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, EXTRACT_WORKERS)) as pool:
+            events = iter_page_events(pool, files, page_counts, page_cache, max(2, 2 * EXTRACT_WORKERS))
+
+            extract_seconds = {"file": 0.0}
+
+            def file_fragments() -> Iterator[str]:
+                # Pull this file's text from the shared event stream up to its "end" event
+                for ev in events:
+                    if ev[0] == "end":
+                        extract_seconds["file"] = ev[2]
+                        return
+                    yield ev[1]
+
+            for ev in events:
+                if errors:
+                    break
+                if ev[0] == "error":
+                    print(f"[SKIP] {ev[1]}: {ev[2]}", flush=True)
+                    est_left -= estimates[ev[1]]
+                    continue
+                _, path, sha1 = ev
+                print(f"[READ] {path}", flush=True)
+
+                # Resume: chunk hashes already stored for this exact file version (in-memory lookup)
+                already = resume_index.chunks_for(sha1)
+
+                # Stream chunks straight into adaptive-size batches; put() blocks when the embedders fall behind
+                f = {"path": path, "sha1": sha1, "n_chunks": 0, "queued": 0, "written": 0, "failed": 0, "upserted": 0,
+                     "added": 0, "reused": 0, "unchanged": 0, "spans": [],
+                     "closed": False, "reported": False, "start": time.time()}
+                t0 = time.time()
+                items: List[Tuple[int, dict, str]] = []
+                n_chunks = 0
+                spans: List[Tuple[int, dict]] = []
+
+                def flush(items: List[Tuple[int, dict, str]]):
+                    # Identical text already embedded anywhere (moved chunk, earlier version) => copy its vector
+                    reused: Dict[str, List[float]] = {}
+                    known = [h for _, _, h in items if h in resume_index.hashes]
+                    if known:
+                        try:
+                            reused = vectors_by_chunk_hash(client, COLLECTION, known)
+                        except Exception as e:
+                            print(f"[WARN] chunk dedup lookup failed: {e}", flush=True)
+                    hit = [it for it in items if it[2] in reused]
+                    miss = [it for it in items if it[2] not in reused]
+                    f["queued"] += len(items)
+                    if hit:
+                        f["reused"] += len(hit)
+                        on_embedded(len(hit))
+                        results.put(({"file": f, "items": hit}, [reused[h] for _, _, h in hit]))
+                    if miss:
+                        f["added"] += len(miss)
+                        jobs.put({"file": f, "items": miss})
+
+                for idx, chunk in enumerate(iter_file_chunks(file_fragments(), path)):
+                    n_chunks += 1
+                    spans.extend((idx, sp) for sp in chunk.get("spans", ()))
+                    h = chunk_sha1(chunk["text"])
+                    if RESUME and idx in already and (already[idx] == h or (already[idx] is None and legacy_ok)):
+                        f["unchanged"] += 1  # same version, same text (or legacy fixed-size point without a hash)
+                        continue
+                    items.append((idx, chunk, h))
+                    if len(items) >= embedder.batch_size:
+                        flush(items)
+                        items = []
+                if items:
+                    flush(items)
+                extract_stats.add(n_chunks, extract_seconds["file"])
+
+                # Refine the progress total: actual counts so far + remaining estimates scaled by what we've seen
+                chunks_seen += n_chunks
+                est_done += estimates[path]
+                est_left -= estimates[path]
+                set_total(chunks_seen + int(est_left * (chunks_seen / est_done)))
+
+                if not n_chunks:
+                    print(f"[SKIP] {path}: no text extracted", flush=True)
+                    continue
+                files_done += 1
+                if RESUME:
+                    print(f"[RESUME] {os.path.basename(path)}: have {f['unchanged']}/{n_chunks}; "
+                          f"reusing {f['reused']}, embedding {f['added']}.", flush=True)
+                with progress_lock:
+                    f["n_chunks"] = n_chunks
+                    f["spans"] = spans
+                    f["closed"] = True
+                    report["added"] += f["added"]
+                    report["reused"] += f["reused"]
+                    report["unchanged"] += f["unchanged"]
+                maybe_finish(f)
+    finally:
+        for _ in workers:
+            jobs.put(None)
+        for t in workers:
+            t.join()
+        results.put(None)
+        writer.join()
+        pbar.close()
+        page_cache.close()
+        if span_store:
+            span_store.close()
+
+    if errors:
+        raise RuntimeError(f"Seeding failed: {errors[0]}")
+
     total_elapsed = time.time() - global_start
+    processed = progress["processed"]
+    total_points = progress["points"]
+
+    if files_done == 0:
+        print("No chunks to embed. Exiting.", flush=True)
+        return
 
     info = client.get_collection(COLLECTION)
     approx_count = client.count(COLLECTION, exact=False).count
@@ -334,8 +1424,16 @@ def main():
     print(f"Collection: {COLLECTION}", flush=True)
     print(f"Status: {info.status}, vectors count (approx): {approx_count}", flush=True)
     print(f"Total upserted this run: {total_points}", flush=True)
+    print(f"Run report: added {report['added']}, reused {report['reused']} (no re-embed), "
+          f"unchanged {report['unchanged']}, removed {report['removed']} stale", flush=True)
     rate_global = (processed / total_elapsed) if total_elapsed > 0 else 0.0
     print(f"Total embedding time: {format_duration(total_elapsed)} ({rate_global:.1f} chunks/sec)", flush=True)
+    print(f"PDF pages: {page_cache.misses} extracted, {page_cache.hits} from page cache", flush=True)
+    if span_store:
+        print(f"Spans: {span_store.written} written to Postgres", flush=True)
+    print("Stage throughput (highest busy % is the bottleneck):", flush=True)
+    for st in (extract_stats, embed_stats, upsert_stats):
+        print(f"  {st.summary(total_elapsed)}", flush=True)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()